@@ -1,4 +1,6 @@
 import asyncio
+from datetime import datetime, UTC
+import functools
 from beanie import WriteRules
 from sanic import Blueprint, Request, json, exceptions
 from sanic_ext import openapi
@@ -14,9 +16,12 @@ from modules.db import (
     Star,
     User,
     Carrier,
+    SpatialGrid,
     distance,
 )
 from modules.auth import authorized
+from modules.combat import distribute_casualties, resolve_combat
+from modules.state import GameState, TickContext, get_state
 from modules import gateway
 from modules.worldgen import (
     generate_carrier_name,
@@ -50,38 +55,40 @@ async def build_carrier(request: Request, game_id: str):
     if not planet_id or ships < 1:
         raise exceptions.BadRequest("Bad Request")
 
-    planet = await Planet.get(planet_id)
-    if not planet:
-        raise exceptions.BadRequest("Bad Request")
+    state = await get_state(game)
+    async with state.lock:
+        planet = state.get_planet(planet_id)
+        if not planet:
+            raise exceptions.BadRequest("Bad Request")
 
-    player = await Player.find_one(
-        Player.game == game.id, Player.user == request.ctx.user.id
-    )
-    if not player:
-        raise exceptions.BadRequest("Bad Request")
+        player = state.get_player_by_user(request.ctx.user.id)
+        if not player:
+            raise exceptions.BadRequest("Bad Request")
 
-    if not planet.occupier == player.id or planet.ships < ships:
-        raise exceptions.BadRequest("Bad Request")
+        if not planet.occupier == player.id or planet.ships < ships:
+            raise exceptions.BadRequest("Bad Request")
 
-    if player.cash < 25:
-        raise exceptions.BadRequest("Bad Request")
+        if player.cash < 25:
+            raise exceptions.BadRequest("Bad Request")
 
-    if not name:
-        name = generate_carrier_name(int(player.color.replace("#", ""), 16))
+        if not name:
+            name = generate_carrier_name(int(player.color.replace("#", ""), 16))
 
-    await player.inc({Player.cash: -25})
+        player.cash -= 25
+        planet.ships -= ships
 
-    carrier = Carrier(
-        game=game.id,
-        ships=ships,
-        destination_queue=[],
-        name=name,
-        owner=player.id,
-        position=planet.position,
-    )
+        carrier = Carrier(
+            game=game.id,
+            ships=ships,
+            destination_queue=[],
+            name=name,
+            owner=player.id,
+            position=planet.position.to_position(),
+        )
+        state.add_carrier(carrier)
 
-    await carrier.save()
-    await planet.inc({Planet.ships: -ships})
+        await carrier.save()
+        await state.save(player, planet)
 
     return json(carrier.dict())
 
@@ -116,42 +123,53 @@ async def transfer_ships(request: Request, game_id: str):
     if not from_id or not to_id or from_id == to_id or not amount:
         raise exceptions.BadRequest("Bad Request")
 
-    carriers = await Carrier.find(
-        And(Carrier.game == game.id, Or(Carrier.id == from_id, Carrier.id == to_id))
-    ).to_list(None)
-    planets = await Planet.find(
-        And(Planet.game == game.id, Or(Planet.id == from_id, Planet.id == to_id))
-    ).to_list(None)
-    entities = carriers + planets
-
-    if not all(
-        player.id
-        == (getattr(entity, "occupier", None) or getattr(entity, "owner", None))
-        for entity in entities
-    ):
-        raise exceptions.BadRequest("Bad Request")
+    state = await get_state(game)
+    async with state.lock:
+        entities = [
+            entity
+            for entity in (
+                state.get_carrier(from_id),
+                state.get_carrier(to_id),
+                state.get_planet(from_id),
+                state.get_planet(to_id),
+            )
+            if entity
+        ]
 
-    from_entity = next((entity for entity in entities if entity.id == from_id), None)
-    to_entity = next((entity for entity in entities if entity.id == to_id), None)
+        if not all(
+            player.id
+            == (getattr(entity, "occupier", None) or getattr(entity, "owner", None))
+            for entity in entities
+        ):
+            raise exceptions.BadRequest("Bad Request")
 
-    if not from_entity or not to_entity:
-        raise exceptions.BadRequest("Bad Request")
+        from_entity = next(
+            (entity for entity in entities if entity.id == from_id), None
+        )
+        to_entity = next((entity for entity in entities if entity.id == to_id), None)
 
-    if amount > from_entity.ships or amount < 1:
-        raise exceptions.BadRequest("Bad Request")
+        if not from_entity or not to_entity:
+            raise exceptions.BadRequest("Bad Request")
 
-    # always keep at least one ship on a carrier
-    if isinstance(from_entity, Carrier) and amount >= from_entity.ships:
-        raise exceptions.BadRequest("Bad Request")
+        if amount > from_entity.ships or amount < 1:
+            raise exceptions.BadRequest("Bad Request")
 
-    # make sure they are close enough together
-    if distance(from_entity.position, to_entity.position) > 0.2:
-        raise exceptions.BadRequest("Bad Request")
+        # always keep at least one ship on a carrier
+        if isinstance(from_entity, Carrier) and amount >= from_entity.ships:
+            raise exceptions.BadRequest("Bad Request")
+
+        # make sure they are close enough together
+        now = datetime.now(UTC)
+        from_position, to_position = (
+            entity.position_at(now) if isinstance(entity, Carrier) else entity.position
+            for entity in (from_entity, to_entity)
+        )
+        if distance(from_position, to_position) > 0.2:
+            raise exceptions.BadRequest("Bad Request")
 
-    from_entity.ships -= amount
-    to_entity.ships += amount
-    await from_entity.inc({from_entity.__class__.ships: -amount})
-    await to_entity.inc({to_entity.__class__.ships: amount})
+        from_entity.ships -= amount
+        to_entity.ships += amount
+        await state.save(from_entity, to_entity)
 
     return json({"success": True})
 
@@ -172,19 +190,6 @@ async def control_carrier(request: Request, game_id: str, carrier_id: str):
     if not data:
         raise exceptions.BadRequest("Bad Request")
 
-    carrier = await Carrier.get(carrier_id)
-    if not carrier:
-        raise exceptions.NotFound("Carrier not found")
-
-    player = await Player.find_one(
-        Player.game == game.id, Player.user == request.ctx.user.id
-    )
-    if not player:
-        raise exceptions.BadRequest("Bad Request")
-
-    if not carrier.owner == player.id:
-        raise exceptions.BadRequest("Bad Request")
-
     name = data.get("name", None)
     destinations = data.get("destinations", None)
 
@@ -193,71 +198,123 @@ async def control_carrier(request: Request, game_id: str, carrier_id: str):
     except TypeError:
         raise exceptions.BadRequest("Bad Request")
 
-    if name:
-        carrier.name = name
+    state = await get_state(game)
+    async with state.lock:
+        carrier = state.get_carrier(carrier_id)
+        if not carrier:
+            raise exceptions.NotFound("Carrier not found")
 
-    if destinations:
-        if (
-            carrier.destination_queue
-            and carrier.destination_queue[0].planet != destinations[0].planet
-        ):
+        player = state.get_player_by_user(request.ctx.user.id)
+        if not player:
             raise exceptions.BadRequest("Bad Request")
 
-        all_planets = await Planet.find(
-            Planet.game == game.id, In(Planet.id, [d.planet for d in destinations])
-        ).to_list(None)
-        last_position = (
-            carrier.position
-            if not carrier.destination_queue
-            else next(
-                (
-                    planet
-                    for planet in all_planets
-                    if planet.id == carrier.destination_queue[0].planet
-                ),
-                None,
-            ).position
-        )
-        for destination in destinations:
-            planet = next(
-                (planet for planet in all_planets if planet.id == destination.planet),
-                None,
-            )
-            if not planet:
-                raise exceptions.BadRequest("Bad Request")
+        if not carrier.owner == player.id:
+            raise exceptions.BadRequest("Bad Request")
+
+        if name:
+            carrier.name = name
 
+        if destinations:
             if (
-                distance(last_position, planet.position)
-                > player.get_hyperspace_distance()
+                carrier.destination_queue
+                and carrier.destination_queue[0].planet != destinations[0].planet
             ):
                 raise exceptions.BadRequest("Bad Request")
 
-            last_position = planet.position
+            last_position = (
+                carrier.position
+                if not carrier.destination_queue
+                else state.get_planet(carrier.destination_queue[0].planet).position
+            )
+            for destination in destinations:
+                planet = state.get_planet(destination.planet)
+                if not planet:
+                    raise exceptions.BadRequest("Bad Request")
 
-        carrier.destination_queue = destinations
+                if (
+                    distance(last_position, planet.position)
+                    > player.get_hyperspace_distance()
+                ):
+                    raise exceptions.BadRequest("Bad Request")
 
-    await carrier.save_changes()
-    return json(carrier.dict())
+                last_position = planet.position
 
+            carrier.destination_queue = destinations
+            if not carrier.in_flight:
+                state.depart(carrier, datetime.now(UTC))
 
-async def carrier_tick(
-    game: Game, stars: list[Star], carriers: list[Carrier], hourly=False
-):
-    planets = [p for s in stars for p in s.planets]
+        await state.save(carrier)
+
+    return json(carrier.dict())
 
-    tasks = []
-    for carrier in carriers:
-        await carrier.move(game, planets)
-        tasks.append(carrier.save_changes())
 
-    await asyncio.gather(*tasks)
+def land_carriers(state: GameState, until: datetime, chain=False) -> list[Carrier]:
+    """
+    Land every carrier due to arrive by until. With chain, carriers head straight
+    off to their next destination from where they landed, so a whole route can
+    be flown in one go. returns the carriers that landed and stayed
+    """
+    landed: dict[str, Carrier] = {}
+    while arrived := state.pop_arrivals(until):
+        for carrier in arrived:
+            arrives_at = carrier.arrives_at
+            planet = state.get_planet(carrier.destination_queue[0].planet)
+            carrier.arrive(planet)
+            state.update_carrier_visibility(carrier)
+            state.mark_dirty(carrier, planet)
+            landed[carrier.id] = carrier
+
+            if chain and carrier.destination_queue:
+                state.depart(carrier, arrives_at)
+
+    return [c for c in landed.values() if not c.in_flight]
+
+
+async def carrier_tick(state: GameState, ctx: TickContext, hourly=False):
+    now = state.game.last_tick_at or datetime.now(UTC)
+
+    # only carriers that got somewhere this tick have anything to do
+    arrived = land_carriers(state, now)
+    await fight(state, ctx, arrived)
+
+    # whoever made it through moves on to their next destination
+    alive = {c.id for c in state.carriers}
+    for carrier in arrived:
+        if carrier.id in alive and carrier.destination_queue:
+            state.depart(carrier, now)
+
+
+async def fight(state: GameState, ctx: TickContext, arrived: list[Carrier] = ()):
+    """
+    resolve a battle at every planet carriers just arrived at, and at any planet
+    the last battle left enemies standing on
+    """
+    if not arrived and not state.contested:
+        # nobody to fight, which is most ticks
+        return
+
+    game = state.game
+    contested = state.contested
+    state.contested = set()
+
+    if arrived:
+        planet_grid = SpatialGrid(state.planets)
+        contested |= {
+            planet.id
+            for carrier in arrived
+            for planet in planet_grid.query(carrier.position, 0.01)
+        }
+
+    # carriers in flight are between planets, so can't be in a fight
+    carrier_grid = SpatialGrid([c for c in state.carriers if not c.in_flight])
 
     # fight me bitch
-    for planet in planets:
+    for planet_id in contested:
+        if not (planet := state.planets_by_id.get(planet_id)):
+            continue
+
         # get all the carriers within fighting distance (say 0.01 LY)
-        close_carriers = [
-            c for c in carriers if distance(c.position, planet.position) < 0.01
-        ]
+        close_carriers = carrier_grid.query(planet.position, 0.01)
 
         defending_carriers = [c for c in close_carriers if c.owner == planet.occupier]
         attacking_carriers = [c for c in close_carriers if c.owner != planet.occupier]
@@ -273,118 +330,81 @@ async def carrier_tick(
             [c.ships for c in close_carriers if c.owner != planet.occupier]
         )
 
-        try:
-            defending_weapons = next(
-                p.research_levels.weapons
-                for p in game.members
-                if p.id == planet.occupier
-            )
-        except StopIteration:
-            defending_weapons = 0
-
-        try:
-            attacking_weapons = max(
-                p.research_levels.weapons
-                for p in game.members
-                if p.id in [c.owner for c in attacking_carriers]
-            )
-        except ValueError:
-            attacking_weapons = 0  # this should never happen but I am a good little programmer and I am handling it anyway
-
-        winner = None
-        attackers_win = False
-
         og_defending_ships = defending_ships
         og_attacking_ships = attacking_ships
-        og_planet_owner = planet.occupier
+        attacking_owners = {c.owner for c in attacking_carriers}
         attacking_members = [
-            p for p in game.members if p.id in [c.owner for c in attacking_carriers]
+            p for p in ctx.players.values() if p.id in attacking_owners
         ]
-        try:
-            defending_member = next(p for p in game.members if p.id == og_planet_owner)
-        except StopIteration:
-            defending_member = None
-
-        while True:
-            if defending_ships > 0:
-                attacking_ships -= defending_weapons + 1
-
-            if attacking_ships <= 0:
-                attacking_ships = 0
-                winner = planet.occupier
-                break
+        defending_member = ctx.players.get(planet.occupier)
 
-            if attacking_ships > 0:
-                defending_ships -= attacking_weapons
+        defending_weapons = (
+            defending_member.research_levels.weapons if defending_member else 0
+        )
+        attacking_weapons = max(
+            (p.research_levels.weapons for p in attacking_members), default=0
+        )  # this should never be empty but I am a good little programmer and I am handling it anyway
 
-            if defending_ships <= 0:
-                defending_ships = 0
-                winner = next(c.owner for c in attacking_carriers)
-                attackers_win = True
-                break
+        attacking_ships, defending_ships, attackers_win = resolve_combat(
+            attacking_ships, defending_ships, attacking_weapons, defending_weapons
+        )
 
         # yield the spoils of war!!
         if attackers_win:
-            planet.occupier = winner
+            winner = attacking_carriers[0].owner
+            ctx.set_occupier(planet, winner)
             planet.ships = 0
             planet.ship_accum = 0
 
             # give the winner star.economy * 10 cash
             if planet.economy > 0:
-                winner_player = next(p for p in game.members if p.id == winner)
-                await winner_player.inc({Player.cash: planet.economy * 10})
+                winner_player = ctx.players[winner]
+                winner_player.cash += planet.economy * 10
+                state.mark_dirty(winner_player)
 
             # your pillaging has consequences
             planet.economy = 0
 
-            casualties = og_attacking_ships - attacking_ships
-
-            if casualties > 0:
-                for i in range(casualties):
-                    attacking_carriers[i % len(attacking_carriers)].ships -= 1
-                    if attacking_carriers[i % len(attacking_carriers)].ships <= 0:
-                        await attacking_carriers[i % len(attacking_carriers)].delete()
-                        attacking_carriers.pop(i % len(attacking_carriers))
-
-                tasks = []
-                for c in attacking_carriers:
-                    tasks.append(c.save_changes())
-                await asyncio.gather(*tasks)
+            left = distribute_casualties(
+                [c.ships for c in attacking_carriers],
+                og_attacking_ships - attacking_ships,
+            )
+            for c, ships in zip(attacking_carriers, left):
+                c.ships = ships
 
             # now nuke the losers
-            await planet.save_changes()
-            if len(defending_carriers) > 0:
-                await Carrier.find(
-                    Carrier.game == game.id,
-                    In(Carrier.id, [c.id for c in defending_carriers]),
-                ).delete_many()
+            destroyed = defending_carriers + [
+                c for c in attacking_carriers if c.ships <= 0
+            ]
+            survivors = [c for c in attacking_carriers if c.ships > 0]
         else:
-            # the defenders win, but at what cost?
-            casualties = og_defending_ships - defending_ships
+            winner = planet.occupier
 
-            if casualties > 0:
-                for i in range(casualties):
-                    if len(defending_carriers) <= 0:
-                        planet.ships -= 1
-                        continue
-                    defending_carriers[i % len(defending_carriers)].ships -= 1
-                    if defending_carriers[i % len(defending_carriers)].ships <= 0:
-                        await defending_carriers[i % len(defending_carriers)].delete()
-                        defending_carriers.pop(i % len(defending_carriers))
+            # the defenders win, but at what cost? carriers soak up hits before the planet
+            casualties = og_defending_ships - defending_ships
+            carrier_ships = sum(c.ships for c in defending_carriers)
+            left = distribute_casualties(
+                [c.ships for c in defending_carriers], casualties
+            )
+            for c, ships in zip(defending_carriers, left):
+                c.ships = ships
+            planet.ships -= max(0, casualties - carrier_ships)
 
-                if len(defending_carriers) > 0:
-                    tasks = []
-                    for c in defending_carriers:
-                        tasks.append(c.save())
-                    await asyncio.gather(*tasks)
+            # the attackers lose lol rip
+            destroyed = attacking_carriers + [
+                c for c in defending_carriers if c.ships <= 0
+            ]
+            survivors = [c for c in defending_carriers if c.ships > 0]
 
-            await planet.save()
+        # a third party can still be sitting here, they get their go next tick
+        if any(c.owner != planet.occupier for c in survivors):
+            state.contested.add(planet.id)
 
-            # the attackers lose lol rip
-            await Carrier.find(
-                Carrier.game == game.id,
-                In(Carrier.id, [c.id for c in attacking_carriers]),
-            ).delete_many()
+        # every carrier lost here goes out in the same batched flush
+        state.mark_dirty(planet, *survivors)
+        ctx.remove_carriers(destroyed)
+        for c in destroyed:
+            carrier_grid.remove(c)
 
         evnt = Event(
             game=game.id,
@@ -400,10 +420,26 @@ async def carrier_tick(
             ),
         )
 
-        await evnt.save()
+        # the war correspondents can file once the fighting is done
+        ctx.reports.append(
+            functools.partial(
+                report_battle, state, evnt, attacking_members, defending_member
+            )
+        )
+
 
-        # create news story
-        # TODO: fix this dumb way of doing this
-        evnt.data.attacking_players = attacking_members
-        evnt.data.defending_players = [defending_member] if defending_member else []
-        await newsgen.create_article(game, evnt, planets)
+async def report_battle(
+    state: GameState,
+    evnt: Event,
+    attacking_members: list[Player],
+    defending_member: Player | None,
+):
+    await evnt.save()
+
+    # create news story
+    # TODO: fix this dumb way of doing this
+    evnt.data.attacking_players = attacking_members
+    evnt.data.defending_players = [defending_member] if defending_member else []
+    await newsgen.create_article(
+        state.game, evnt, state.planet_counts, len(state.planets)
+    )
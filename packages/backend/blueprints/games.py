@@ -17,7 +17,8 @@ from modules.db import (
     distance,
 )
 from modules.auth import authorized
-from modules import gateway
+from modules.state import get_state, resetting
+from modules import gateway, registry
 from modules.worldgen import generate_star_name, generate_star_positions
 from beanie.operators import Or
 
@@ -136,8 +137,18 @@ async def join_game(request: Request, game_id: str):
         cash=game.settings.starting_cash,
     )
 
-    game.members.append(new_player)
-    await game.save(link_rule=WriteRules.WRITE)
+    if game.started_at:
+        # the running game's roster lives with whoever holds it, so the join has
+        # to happen there (anyone else gets NotLeader and forwards it)
+        state = await get_state(game)
+        async with state.lock:
+            game.members.append(new_player)
+            await game.save(link_rule=WriteRules.WRITE)
+            state.game.members.append(new_player)
+        registry.track(game)
+    else:
+        game.members.append(new_player)
+        await game.save(link_rule=WriteRules.WRITE)
 
     return json(game.dict())
 
@@ -240,6 +251,8 @@ async def start_game(request: Request, game_id: str):
     game.started_at = datetime.now(UTC)
     await game.save()
     await generate_map(game)
+    await get_state(game)
+    registry.track(game)
 
     return json(game.dict())
 
@@ -258,20 +271,30 @@ async def restart_game(request: Request, game_id: str):
     if not game.started_at:
         raise exceptions.BadRequest("Game not yet started")
 
-    game.started_at = datetime.now(UTC)
-    game.winner = None
-    await Star.find(Star.game == game.id).delete_many()
-    await Event.find(Event.game == game.id).delete_many()
-    await Census.find(Census.game == game.id).delete_many()
-    await News.find(News.game == game.id).delete_many()
-    await Planet.find(Planet.game == game.id).delete_many()
-    await Message.find(Message.game == game.id).delete_many()
-    await Carrier.find(Carrier.game == game.id).delete_many()
-    await Player.find(Player.game == game.id).update_many(
-        {"$set": {"cash": game.settings.starting_cash}}
-    )
-    await game.save()
-    await generate_map(game)
+    # make sure we are the instance holding this game, then stop ticking it and
+    # keep it unloaded until the new galaxy is in place
+    await get_state(game)
+    registry.forget(game.id)
+    async with resetting(game.id):
+        game.started_at = datetime.now(UTC)
+        game.last_tick_at = None
+        game.winner = None
+        await Star.find(Star.game == game.id).delete_many()
+        await Event.find(Event.game == game.id).delete_many()
+        await Census.find(Census.game == game.id).delete_many()
+        await News.find(News.game == game.id).delete_many()
+        await Planet.find(Planet.game == game.id).delete_many()
+        await Message.find(Message.game == game.id).delete_many()
+        await Carrier.find(Carrier.game == game.id).delete_many()
+        await Player.find(Player.game == game.id).update_many(
+            {"$set": {"cash": game.settings.starting_cash}}
+        )
+        await game.save()
+        await generate_map(game)
+
+    game = await Game.get(game.id, fetch_links=True)
+    await get_state(game)
+    registry.track(game)
     on_scan(game)
 
     return json(game.dict())
@@ -1,9 +1,12 @@
 import asyncio
+from datetime import datetime, UTC
 from modules.db import Carrier, Game, Planet, Player, Star
 import asyncio
 from sanic import Blueprint, Request, json, exceptions
 from sanic_ext import openapi
 from modules.auth import authorized
+from modules.kernels import drag_parked_carriers, tick_planets
+from modules.state import GameState, TickContext, get_state
 from beanie.operators import Or, And, In
 
 bp = Blueprint("planets")
@@ -36,33 +39,36 @@ async def upgrade_star(request: Request, game_id: str, planet_id: str):
     if aspect not in ["economy", "industry", "science"]:
         raise exceptions.BadRequest("Bad Request")
 
-    planet = await Planet.find_one(And(Planet.game == game.id, Planet.id == planet_id))
-    if not planet:
-        raise exceptions.NotFound("Star not found")
+    state = await get_state(game)
+    async with state.lock:
+        player = state.get_player(player.id)
+        planet = state.get_planet(planet_id)
+        if not planet:
+            raise exceptions.NotFound("Star not found")
 
-    costs = planet.get_all_costs(player.research_levels.terraforming)
-    print(costs)
-    if costs[aspect] > player.cash:
-        raise exceptions.BadRequest("Not enough resources")
+        costs = planet.get_all_costs(player.research_levels.terraforming)
+        print(costs)
+        if costs[aspect] > player.cash:
+            raise exceptions.BadRequest("Not enough resources")
 
-    player.cash -= costs[aspect]
-    setattr(planet, aspect, getattr(planet, aspect) + 1)
+        player.cash -= costs[aspect]
+        setattr(planet, aspect, getattr(planet, aspect) + 1)
 
-    await asyncio.gather(
-        player.inc({Player.cash: -costs[aspect]}), planet.inc({aspect: 1})
-    )
+        await state.save(player, planet)
 
     return json(planet.dict())
 
 
-async def planet_tick(
-    game: Game, stars: list[Star], carriers: list[Carrier], hourly=False
-):
-    tasks = []
-    for star in stars:
-        for planet in star.planets:
-            planet.do_production(game)
-            await planet.do_orbit(game, stars, carriers)
-            tasks.append(planet.save_changes())
+async def planet_tick(state: GameState, ctx: TickContext, hourly=False):
+    now = state.game.last_tick_at or datetime.now(UTC)
+    arrays = state.planet_arrays
+    arrays.gather(ctx.players.values())
+    old_x, old_y = arrays.x, arrays.y
+
+    await tick_planets(arrays, state.game.settings, now.timestamp())
+    moved = drag_parked_carriers(arrays, old_x, old_y, state.carriers)
 
-    await asyncio.gather(*tasks)
+    # carriers and combat need the new positions this tick, so sync them back now.
+    # positions aren't stored, so only planets that can produce have anything to write
+    arrays.scatter()
+    state.mark_dirty(*(p for p in state.planets if p.occupier), *moved)
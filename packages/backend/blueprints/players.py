@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import time
 from beanie import WriteRules
 from sanic import Blueprint, Request, json, exceptions
@@ -20,6 +21,13 @@ from modules.db import (
     Technology,
 )
 from modules.auth import authorized
+from modules.state import (
+    GameState,
+    TickContext,
+    count_planets,
+    get_loaded_state,
+    get_state,
+)
 from modules import gateway
 from modules.worldgen import (
     generate_carrier_name,
@@ -39,12 +47,6 @@ async def edit_player(request: Request, game_id: str, player_id: str):
         raise exceptions.Forbidden("You can only edit your own player")
 
     data = request.json
-    player = await Player.find_one(
-        Player.user == request.ctx.user.id, Player.game == game_id
-    )
-    if not player:
-        raise exceptions.NotFound("Player not found")
-
     research_queue = data.get("research_queue")
 
     if not research_queue:
@@ -60,8 +62,25 @@ async def edit_player(request: Request, game_id: str, player_id: str):
         if tech_id not in Technology.all():
             raise exceptions.BadRequest("Invalid tech id")
 
-    player.research_queue = research_queue
-    await player.save_changes()
+    game = await Game.get(game_id, fetch_links=True)
+    if game and game.started_at:
+        state = await get_state(game)
+        async with state.lock:
+            player = state.get_player_by_user(request.ctx.user.id)
+            if not player:
+                raise exceptions.NotFound("Player not found")
+
+            player.research_queue = research_queue
+            await state.save(player)
+    else:
+        player = await Player.find_one(
+            Player.user == request.ctx.user.id, Player.game == game_id
+        )
+        if not player:
+            raise exceptions.NotFound("Player not found")
+
+        player.research_queue = research_queue
+        await player.save_changes()
 
     return json(player.dict())
 
@@ -120,27 +139,35 @@ async def create_statement(request: Request, game_id: str):
 
     await evnt.save()
 
-    stars = await Star.find(Star.game == game_id).to_list(None)
-    news = await newsgen.create_article(game, evnt, stars)
+    if state := get_loaded_state(game_id):
+        planet_counts, total_planets = state.planet_counts, len(state.planets)
+    else:
+        stars = await Star.find(Star.game == game_id, fetch_links=True).to_list(None)
+        planets = [p for s in stars for p in s.planets]
+        planet_counts, total_planets = count_planets(planets), len(planets)
+
+    news = await newsgen.create_article(game, evnt, planet_counts, total_planets)
 
     return json(news.dict())
 
 
-async def player_tick(game: Game, stars: list[Star], hourly=False):
+async def player_tick(state: GameState, ctx: TickContext, hourly=False):
     is_production_tick = hourly and time.gmtime().tm_hour == 2
 
-    planets = [p for s in stars for p in s.planets]
+    game = state.game
+    planets = state.planets
 
     for player in game.members:
+        owned = ctx.owned_planets(player.id)
         if hourly:
-            player.do_research(game, planets)
-        player.do_economy(planets)
+            player.do_research(game, owned)
+        player.do_economy(owned)
 
         # check if its midnight UTC
         if is_production_tick:
-            player.do_production(planets)
+            player.do_production(owned)
 
-        await player.save_changes()
+        state.mark_dirty(player)
 
     if is_production_tick:
         total_cash_created = sum([p.economy for p in planets]) * 10
@@ -153,6 +180,12 @@ async def player_tick(game: Game, stars: list[Star], hourly=False):
             ),
         )
 
-        await evnt.save()
+        ctx.reports.append(functools.partial(report_production, state, evnt))
+
 
-        await newsgen.create_article(game, evnt, planets)
+async def report_production(state: GameState, evnt: Event):
+    await evnt.save()
+
+    await newsgen.create_article(
+        state.game, evnt, state.planet_counts, len(state.planets)
+    )
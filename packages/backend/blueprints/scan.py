@@ -9,11 +9,14 @@ from modules.db import (
     Planet,
     Player,
     Game,
+    Relay,
     Star,
-    distance,
+    as_utc,
 )
 from modules.auth import authorized
-from modules import gateway
+from modules.state import GameState, get_loaded_state
+from modules import gateway, relay
+from modules.visibility import get_visibility
 import aiocron
 from typing import TypedDict
 from modules.utils import print
@@ -32,6 +35,120 @@ class ScanResponse(TypedDict):
     carriers: list[Carrier]
 
 
+class ScanSnapshot:
+    """
+    Everything a scan is built from, for one game at one point in time. Loaded
+    once and projected for each player, so a scan for every member costs one
+    set of reads and one serialization of each thing instead of one per player.
+    """
+
+    def __init__(
+        self,
+        game: Game,
+        players: list[Player],
+        stars: list[Star],
+        planets: list[Planet],
+        carriers: list[Carrier],
+        state: GameState | None = None,
+    ):
+        self.game = game
+        self.players = players
+        self.planets = planets
+        self.carriers = carriers
+        # resident games keep what players can see between scans
+        self.visibility = state.visibility if state else {}
+
+        now = datetime.now(UTC)
+        # resident planets are where the last tick put them
+        last_tick_at = state and state.game.last_tick_at
+        self.placed_at = as_utc(last_tick_at) if last_tick_at else now
+        self.stars = [star.dict() for star in stars]
+        self.carrier_positions = [c.position_at(now) for c in carriers]
+
+        # serialized on first use and shared by every projection
+        self._player_dicts: dict[str, tuple[dict, dict]] = {}
+        self._planet_dicts: dict[str, tuple[dict, dict]] = {}
+        self._carrier_dicts: dict[str, tuple[dict, dict]] = {}
+
+    def get_player(self, user_id: str = None, player_id: str = None) -> Player:
+        return next(
+            p
+            for p in self.players
+            if ((p.user == user_id) if user_id else (p.id == player_id))
+        )
+
+    def player_dict(self, player: Player, own: bool) -> dict:
+        if player.id not in self._player_dicts:
+            self._player_dicts[player.id] = (player.dict(), player.dict_not_self())
+        return self._player_dicts[player.id][0 if own else 1]
+
+    def planet_dict(self, planet: Planet, scanned: bool) -> dict:
+        if planet.id not in self._planet_dicts:
+            self._planet_dicts[planet.id] = (planet.dict(), planet.dict_unscanned())
+        return self._planet_dicts[planet.id][0 if scanned else 1]
+
+    def carrier_dict(self, carrier: Carrier, own: bool) -> dict:
+        if carrier.id not in self._carrier_dicts:
+            self._carrier_dicts[carrier.id] = (carrier.dict(), carrier.dict_not_self())
+        return self._carrier_dicts[carrier.id][0 if own else 1]
+
+    def project(self, player: Player) -> ScanResponse:
+        """
+        what one player gets to see of the snapshot
+        """
+        seen = get_visibility(
+            self.visibility,
+            player,
+            self.game,
+            self.placed_at,
+            self.planets,
+            self.carriers,
+        )
+
+        scan: ScanResponse = {
+            "game": self.game.id,
+            "players": [self.player_dict(p, p.id == player.id) for p in self.players],
+            "stars": self.stars,
+            "planets": [],
+            "carriers": [],
+        }
+
+        # filter things
+        for carrier, position in zip(self.carriers, self.carrier_positions):
+            own = carrier.owner == player.id
+            if own or seen.sees_carrier(carrier, position):
+                scan["carriers"].append(self.carrier_dict(carrier, own))
+
+        for planet in self.planets:
+            scanned = planet.occupier == player.id or planet.id in seen.planets
+            scan["planets"].append(self.planet_dict(planet, scanned))
+
+        return scan
+
+
+async def load_snapshot(game: Game) -> ScanSnapshot:
+    if state := get_loaded_state(game.id):
+        # resident state is ahead of mongo until it gets flushed, and taking it
+        # from there doesn't touch the database at all
+        return ScanSnapshot(
+            game, state.members, state.stars, state.planets, state.carriers, state
+        )
+
+    players, stars, carriers = await asyncio.gather(
+        Player.find(Player.game == game.id).to_list(None),
+        Star.find(Star.game == game.id, fetch_links=True).to_list(None),
+        Carrier.find(Carrier.game == game.id).to_list(None),
+    )
+
+    now = datetime.now(UTC)
+    for star in stars:
+        for planet in star.planets:
+            planet.place(star, game, now)
+    planets = [p for s in stars for p in s.planets]
+
+    return ScanSnapshot(game, players, stars, planets, carriers)
+
+
 async def scan_game(
     game_id: str = None, game: Game = None, user_id: str = None, player_id: str = None
 ) -> ScanResponse:
@@ -55,62 +172,8 @@ async def scan_game(
     if not game:
         raise exceptions.NotFound("Game not found")
 
-    if not game_id:
-        game_id = game.id
-
-    players = await Player.find(Player.game == game_id).to_list(None)
-    stars = await Star.find(Star.game == game_id, fetch_links=True).to_list(None)
-    planets = [p for s in stars for p in s.planets]
-    carriers = await Carrier.find(Carrier.game == game_id).to_list(None)
-
-    current_player = next(
-        p for p in players if ((p.user == user_id) if user_id else (p.id == player_id))
-    )
-    player_planets = [p for p in planets if p.occupier == current_player.id]
-    scan_distance = current_player.get_scan_distance()
-
-    scan: ScanResponse = {
-        "game": game.id,
-        "players": [
-            (p.dict() if p.id == current_player.id else p.dict_not_self())
-            for p in players
-        ],
-        "stars": [star.dict() for star in stars],
-        "planets": [],
-        "carriers": [],
-    }
-
-    # filter things
-    scan["carriers"] = [
-        (c.dict() if c.owner == current_player.id else c.dict_not_self())
-        for c in carriers
-        if (
-            any(
-                distance((c.position.x, c.position.y), (p.position.x, p.position.y))
-                <= scan_distance
-                for p in player_planets
-            )
-            or c.owner == current_player.id
-        )
-    ]
-
-    for planet in planets:
-        if (
-            any(
-                distance(
-                    (planet.position.x, planet.position.y),
-                    (p.position.x, p.position.y),
-                )
-                <= scan_distance
-                for p in player_planets
-            )
-            or planet.occupier == current_player.id
-        ):
-            scan["planets"].append(planet.dict())
-        else:
-            scan["planets"].append(planet.dict_unscanned())
-
-    return scan
+    snapshot = await load_snapshot(game)
+    return snapshot.project(snapshot.get_player(user_id=user_id, player_id=player_id))
 
 
 @bp.route("/v1/games/<game_id>/scan", methods=["GET"])
@@ -121,15 +184,26 @@ async def get_scan(request: Request, game_id: str):
     return json(await scan_game(game_id=game_id, user_id=request.ctx.user.id))
 
 
-async def send_scan(game: Game, player: Player):
-    scan = await scan_game(game=game, player_id=player.id)
-    gateway.send_to_user(
-        player.user,
-        gateway.GatewayOpCode.GALAXY_SCAN,
-        scan,
+async def send_scans(game: Game):
+    # only players watching over the gateway get pushed scans, everyone else
+    # builds one when they ask for it. sockets on other instances get theirs
+    # relayed through mongo
+    remote = await relay.holders(
+        [p.user for p in game.members if not gateway.is_connected(p.user)]
     )
+    if not remote and not any(gateway.is_connected(p.user) for p in game.members):
+        return
+
+    snapshot = await load_snapshot(game)
+    relays = []
+    for player in snapshot.players:
+        if gateway.is_connected(player.user):
+            gateway.send_scan(player.user, snapshot.project(player))
+        elif instance := remote.get(player.user):
+            scan = snapshot.project(player)
+            relays.append(Relay(instance=instance, user=player.user, scan=scan))
+    await relay.forward(relays)
 
 
 def on_scan(game: Game):
-    for player in game.members:
-        asyncio.create_task(send_scan(game, player))
+    asyncio.create_task(send_scans(game))
@@ -2,16 +2,16 @@ import datetime
 from os import getenv
 from dotenv import load_dotenv
 from sanic_ext import openapi
-from sanic import Request, Sanic, json, text
+from sanic import Request, Sanic, empty, exceptions, json, text
 import bcrypt
 import pkgutil
 
 from modules.db import Message, User, Player, Game
 from modules.utils import from_wh, print, wh_msg
 from modules.gateway import GatewayOpCode
-from modules import gateway, db
+from modules import gateway, db, journal, kernels, leases, registry, relay, state
 from modules.auth import authenticate
-from modules.runtime import games_tick, hourly_tick
+from modules.runtime import games_tick, scheduler
 
 load_dotenv()
 
@@ -30,11 +30,40 @@ app.ext.openapi.add_security_scheme("api_key", "apiKey")
 @app.after_server_start
 async def attach_db(app, loop):
     await db.init()
+    await journal.replay()
+    await registry.load()
+    await state.load_all_states()
+
     games_tick.loop = loop
     games_tick.start()
+    app.add_task(relay.run())
+
+
+@app.before_server_stop
+async def flush_state(app, loop):
+    games_tick.stop()
+    await scheduler.stop()
+    await state.flush_all_states()
+    kernels.shutdown_pool()
+    # let the other instances pick our games up straight away
+    await leases.release_all()
+
 
-    hourly_tick.loop = loop
-    hourly_tick.start()
+@app.exception(leases.NotLeader)
+async def replay_to_leader(request: Request, exception: leases.NotLeader):
+    # another instance has this game in memory, have fly send the request there.
+    # fly can only pick the machine, so another worker on this one can't be
+    # reached and the client has to try again
+    if not exception.holder:
+        raise exceptions.ServiceUnavailable("Game is changing hands, try again")
+    if not (
+        leases.MACHINE_ID
+        and exception.machine
+        and exception.machine != leases.MACHINE_ID
+    ):
+        raise exceptions.ServiceUnavailable("Game is held by another worker, try again")
+
+    return empty(headers={"fly-replay": f"instance={exception.holder}"})
 
 
 blueprint_names = [
@@ -63,6 +92,7 @@ async def feed(request: Request, ws: gateway.Websocket):
         return
 
     gateway.add_websocket_connection(user.id, ws)
+    await relay.connected(user.id)
 
     try:
         await ws.send(wh_msg(GatewayOpCode.READY))
@@ -72,8 +102,13 @@ async def feed(request: Request, ws: gateway.Websocket):
                 await ws.send(wh_msg(GatewayOpCode.PONG))
                 continue
 
+            if op == GatewayOpCode.GALAXY_SCAN_ACK and isinstance(data, dict):
+                gateway.ack_scan(user.id, data.get("game"), data.get("seq"))
+                continue
+
     finally:
         gateway.remove_websocket_connection(user.id)
+        await relay.disconnected(user.id)
 
 
 app.ext.openapi.secured("api_key")
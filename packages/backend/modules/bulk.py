@@ -0,0 +1,56 @@
+import asyncio
+from collections import defaultdict
+
+from beanie import Document
+from pymongo import DeleteMany, UpdateOne
+
+
+class WriteCollector:
+    """
+    Accumulates changes to documents and writes them out as one unordered
+    bulk_write per collection instead of one round trip per document.
+    """
+
+    def __init__(self):
+        self.ops: dict[type[Document], list] = defaultdict(list)
+        self.updated: list[Document] = []
+
+    def __len__(self):
+        return sum(len(ops) for ops in self.ops.values())
+
+    def update(self, doc: Document):
+        """
+        queue the changed fields of a document (needs state management)
+        """
+        if not doc.is_changed:
+            return
+
+        self.ops[type(doc)].append(
+            UpdateOne({"_id": doc.id}, {"$set": doc.get_changes()})
+        )
+        self.updated.append(doc)
+
+    def set(self, model: type[Document], doc_id: str, fields: dict):
+        self.ops[model].append(UpdateOne({"_id": doc_id}, {"$set": fields}))
+
+    def delete(self, model: type[Document], ids: list[str]):
+        if ids:
+            self.ops[model].append(DeleteMany({"_id": {"$in": list(ids)}}))
+
+    async def commit(self) -> int:
+        count = len(self)
+        ops, updated = self.ops, self.updated
+        self.ops, self.updated = defaultdict(list), []
+
+        await asyncio.gather(
+            *[
+                model.get_motor_collection().bulk_write(model_ops, ordered=False)
+                for model, model_ops in ops.items()
+            ]
+        )
+
+        # the queued changes are in mongo now, so this is the new baseline
+        for doc in updated:
+            doc._save_state()
+
+        return count
@@ -0,0 +1,67 @@
+import math
+
+
+def resolve_combat(
+    attacking_ships: int,
+    defending_ships: int,
+    attacking_weapons: int,
+    defending_weapons: int,
+) -> tuple[int, int, bool]:
+    """
+    Work out a battle without playing it round by round. Every round the
+    defenders shoot first (weapons + 1 per round), then the attackers shoot back
+    if any are left.
+
+    returns (attacking ships left, defending ships left, attackers won)
+    """
+    if defending_ships <= 0:
+        # nobody home, the attackers just walk in
+        return attacking_ships, 0, True
+
+    defender_damage = defending_weapons + 1
+    attacker_rounds = math.ceil(attacking_ships / defender_damage)
+
+    if attacking_weapons > 0:
+        defender_rounds = math.ceil(defending_ships / attacking_weapons)
+        if defender_rounds < attacker_rounds:
+            return attacking_ships - defender_rounds * defender_damage, 0, True
+
+    # attackers get wiped out in their last round before they can fire
+    return 0, defending_ships - (attacker_rounds - 1) * attacking_weapons, False
+
+
+def distribute_casualties(ships: list[int], casualties: int) -> list[int]:
+    """
+    Take casualties one ship at a time from each fleet in turn, skipping fleets
+    that are gone. returns how many ships each fleet has left
+    """
+    n = len(ships)
+    order = sorted(range(n), key=lambda i: ships[i])
+
+    level = 0  # ships taken from every fleet still alive
+    dead = 0  # fleets in order[:dead] have been wiped out
+    while casualties > 0 and dead < n:
+        alive = n - dead
+        step = ships[order[dead]] - level
+
+        if step * alive > casualties:
+            level += casualties // alive
+            casualties %= alive
+            break
+
+        casualties -= step * alive
+        level += step
+        while dead < n and ships[order[dead]] <= level:
+            dead += 1
+
+    left = [max(0, s - level) for s in ships]
+
+    # whatever doesn't divide evenly comes off the first fleets still standing
+    for i in range(n):
+        if casualties <= 0:
+            break
+        if left[i] > 0:
+            left[i] -= 1
+            casualties -= 1
+
+    return left
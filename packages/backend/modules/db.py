@@ -1,4 +1,4 @@
-from datetime import datetime, UTC
+from datetime import datetime, timedelta, UTC
 from enum import Enum
 import math
 import random
@@ -13,7 +13,8 @@ import asyncio
 from typing import Optional
 
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field
+from pymongo import ASCENDING, IndexModel
+from pydantic import BaseModel, Field, PrivateAttr
 
 from beanie import Document, Indexed, init_beanie, Link, BackLink
 
@@ -27,12 +28,80 @@ def convert_dates_to_iso(d):
     return d
 
 
-def distance(a, b):
-    if isinstance(a, Position):
-        a = (a.x, a.y)
-    if isinstance(b, Position):
-        b = (b.x, b.y)
-    return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
+def as_utc(d: datetime) -> datetime:
+    # mongo hands datetimes back without a timezone, they are always utc
+    return d if d.tzinfo else d.replace(tzinfo=UTC)
+
+
+def distance(a, b) -> float:
+    # anything with an x and a y, Position or Vec
+    return math.hypot(a.x - b.x, a.y - b.y)
+
+
+class SpatialGrid:
+    """
+    Uniform grid bucketing items by position, for "what is within r of this
+    point" queries without scanning everything. Build one per tick, positions
+    are read once when items are added.
+    """
+
+    def __init__(self, items=(), cell_size: float = 1.0, key=None):
+        self.cell_size = cell_size
+        self.key = key or (lambda item: (item.position.x, item.position.y))
+        self.cells: dict[tuple[int, int], list] = {}
+        self.item_cells: dict[int, tuple[int, int]] = {}
+        for item in items:
+            self.add(item)
+
+    def _cell(self, x: float, y: float) -> tuple[int, int]:
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def add(self, item):
+        x, y = self.key(item)
+        cell = self._cell(x, y)
+        self.cells.setdefault(cell, []).append((x, y, item))
+        self.item_cells[id(item)] = cell
+
+    def remove(self, item):
+        if (cell := self.item_cells.pop(id(item), None)) is None:
+            return
+        self.cells[cell] = [e for e in self.cells[cell] if e[2] is not item]
+
+    def query(self, point, r: float) -> list:
+        """
+        all items strictly closer than r to point, nearest first
+        """
+        px, py = point.x, point.y
+
+        min_x, min_y = self._cell(px - r, py - r)
+        max_x, max_y = self._cell(px + r, py + r)
+
+        found = []
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                for x, y, item in self.cells.get((cx, cy), ()):
+                    d = math.hypot(x - px, y - py)
+                    if d < r:
+                        found.append((d, item))
+
+        found.sort(key=lambda f: f[0])
+        return [item for _, item in found]
+
+    def any_within(self, point, r: float) -> bool:
+        """
+        whether anything is within r of point, r included. stops at the first
+        """
+        px, py = point.x, point.y
+
+        min_x, min_y = self._cell(px - r, py - r)
+        max_x, max_y = self._cell(px + r, py + r)
+
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                for x, y, _ in self.cells.get((cx, cy), ()):
+                    if math.hypot(x - px, y - py) <= r:
+                        return True
+        return False
 
 
 class User(Document):
@@ -102,6 +171,11 @@ class GameSettings(BaseModel):
     banking_cost: int = Field(default=144)
     weapons_cost: int = Field(default=144)
 
+    @property
+    def orbit_speed(self) -> float:
+        # light years a planet travels along its orbit per minute
+        return (self.carrier_speed * 0.6) / 60
+
 
 class Position(BaseModel):
     x: float
@@ -135,6 +209,53 @@ class Position(BaseModel):
         return Position(x=self.x // other, y=self.y // other)
 
 
+class Vec:
+    """
+    Bare x/y pair for working positions out in the tick. Position validates on
+    every construction, so it is only used where positions get stored or sent
+    out, and converted to and from here.
+    """
+
+    __slots__ = ("x", "y")
+
+    def __init__(self, x: float, y: float):
+        self.x = x
+        self.y = y
+
+    @classmethod
+    def of(cls, position) -> "Vec":
+        return cls(position.x, position.y)
+
+    def to_position(self) -> Position:
+        # the floats are already good, skip validation
+        return Position.model_construct(x=self.x, y=self.y)
+
+    def dict(self) -> dict:
+        return {"x": self.x, "y": self.y}
+
+    def __iter__(self):
+        yield self.x
+        yield self.y
+
+    def __repr__(self):
+        return f"({self.x}, {self.y})"
+
+    def __eq__(self, other):
+        return self.x == other.x and self.y == other.y
+
+    def __add__(self, other):
+        return Vec(self.x + other.x, self.y + other.y)
+
+    def __sub__(self, other):
+        return Vec(self.x - other.x, self.y - other.y)
+
+    def __mul__(self, other):
+        return Vec(self.x * other, self.y * other)
+
+    def __truediv__(self, other):
+        return Vec(self.x / other, self.y / other)
+
+
 class Game(Document):
     id: str = Field(default_factory=generate_id)
     name: str
@@ -147,6 +268,9 @@ class Game(Document):
     )  # winner of the game, None if not finished
     password: Optional[str] = Field(default=None)
     settings: GameSettings
+    last_tick_at: Optional[datetime] = Field(
+        default=None
+    )  # when the last tick was due, used to catch up on missed ticks
 
     def dict(self):
         d = super().model_dump(exclude={"password"})
@@ -155,6 +279,8 @@ class Game(Document):
     class Settings:
         name = "games"
         use_state_management = True
+        # so the active game registry can pick up newly started games cheaply
+        indexes = [IndexModel([("started_at", ASCENDING)])]
 
 
 class Technology:
@@ -306,6 +432,7 @@ class Star(Document):
                 name=Planet.generate_planet_name(self.name, i),
                 occupier=None,
                 resources=random.randint(1, 50),
+                epoch=datetime.now(UTC),
             )
 
             planet.position = planet.get_position([self])
@@ -325,6 +452,7 @@ class Star(Document):
                 industry=game.settings.starting_industry,
                 science=game.settings.starting_science,
                 ships=game.settings.starting_ships,
+                epoch=datetime.now(UTC),
             )
 
             planet.position = planet.get_position([self])
@@ -337,8 +465,10 @@ class Planet(Document):
     game: str
     orbits: str
     distance: float
-    theta: float = Field(default_factory=lambda: random.random() * math.pi * 2)
-    position: Position = Field(default_factory=lambda: Position(x=0, y=0))
+    theta: float = Field(
+        default_factory=lambda: random.random() * math.pi * 2
+    )  # angle around the star at epoch
+    epoch: Optional[datetime] = Field(default=None)
     name: str
     occupier: Optional[str] = Field(default=None)
     ships: int = Field(default=0)
@@ -351,6 +481,19 @@ class Planet(Document):
     resources: int = Field(default=0)
     warp_gate: bool = Field(default=False)
 
+    # the orbit only depends on time, so where the planet is gets worked out on
+    # load and every tick instead of being stored
+    _center: Optional[Vec] = PrivateAttr(default=None)
+    _position: Vec = PrivateAttr(default_factory=lambda: Vec(0, 0))
+
+    @property
+    def position(self) -> Vec:
+        return self._position
+
+    @position.setter
+    def position(self, position: Vec):
+        self._position = position
+
     def get_economy_upgrade_cost(self, terraforming_level: int = 1):
         return (2.5 * 2 * (self.economy + 1)) / (
             (self.resources + (5 * terraforming_level)) / 100
@@ -381,13 +524,34 @@ class Planet(Document):
         star = next((s for s in stars if s.id == self.orbits), None)
         if not star:
             return None
-        return Position(
-            x=star.position.x + self.distance * math.cos(self.theta),
-            y=star.position.y + self.distance * math.sin(self.theta),
+        return Vec(
+            star.position.x + self.distance * math.cos(self.theta),
+            star.position.y + self.distance * math.sin(self.theta),
+        )
+
+    def theta_at(self, game: Game, t: datetime) -> float:
+        if not self.epoch:
+            return self.theta
+        minutes = (t - as_utc(self.epoch)).total_seconds() / 60
+        return self.theta + game.settings.orbit_speed * minutes / self.distance
+
+    def position_at(self, game: Game, t: datetime) -> Vec:
+        """
+        where the planet is in its orbit at a point in time
+        """
+        theta = self.theta_at(game, t)
+        return Vec(
+            self._center.x + self.distance * math.cos(theta),
+            self._center.y + self.distance * math.sin(theta),
         )
 
+    def place(self, star: Star, game: Game, t: datetime):
+        self._center = Vec.of(star.position)
+        self._position = self.position_at(game, t)
+
     def dict(self):
         d = super().model_dump()
+        d["position"] = self.position.dict()
         return convert_dates_to_iso(d)
 
     @staticmethod
@@ -412,68 +576,9 @@ class Planet(Document):
             "ship_accum",
         ):
             del d[k]
+        d["position"] = self.position.dict()
         return convert_dates_to_iso(d)
 
-    def do_production(self, game: Game):
-        """
-        Produces ships via industry * (occupier.manufacturing + 5) / game production length
-        """
-        if not self.occupier:
-            return
-
-        owner = next(p for p in game.members if p.id == self.occupier)
-        if not owner:
-            return
-
-        self.ship_accum += (
-            self.industry
-            * (owner.research_levels.manufacturing + 5)
-            / game.settings.production_cycle_length
-            / 60  # because we are running this every minute
-        )
-        self.ships += int(self.ship_accum)
-        self.ship_accum -= int(self.ship_accum)
-
-    async def do_orbit(self, game: Game, stars: list[Star], carriers: list["Carrier"]):
-        """
-        orbit around star
-        """
-        star = next((s for s in stars if s.id == self.orbits), None)
-        if not star:
-            return
-
-        orbit_speed = (game.settings.carrier_speed * 0.6) / 60
-
-        # rotate around star by speed, make sure actual distance moved is based on speed, dont just rotate by speed
-        r = distance(self.position, star.position)
-        new_theta = self.theta + orbit_speed / r
-
-        new_position = Position(
-            x=star.position.x + r * math.cos(new_theta),
-            y=star.position.y + r * math.sin(new_theta),
-        )
-
-        # find all the carriers currently on the planet
-        carriers_on_planet = [
-            c
-            for c in carriers
-            if distance(c.position, self.position) < 0.01
-            and len(c.destination_queue) == 0
-        ]
-
-        # move the carriers
-        save_tasks = []
-        for carrier in carriers_on_planet:
-            carrier.position.x = new_position.x
-            carrier.position.y = new_position.y
-            save_tasks.append(carrier.save_changes())
-
-        if save_tasks:
-            await asyncio.gather(*save_tasks)
-
-        self.theta = new_theta
-        self.position = new_position
-
     class Settings:
         name = "planets"
         use_state_management = True
@@ -489,67 +594,101 @@ class Carrier(Document):
     game: str
     owner: str
     name: str
-    position: Position
+    position: Position  # where the carrier is parked, or where its current leg started
     destination_queue: list[Destination] = Field(default_factory=list)
     ships: int = Field(default=0)
 
+    # the leg currently being flown, None while parked
+    target: Optional[Position] = Field(default=None)
+    departed_at: Optional[datetime] = Field(default=None)
+    arrives_at: Optional[datetime] = Field(default=None)
+
     def dict(self):
         d = super().model_dump()
-        return d
+        d["position"] = self.position_at(datetime.now(UTC)).dict()
+        return convert_dates_to_iso(d)
 
     def dict_not_self(self):
-        d = super().model_dump()
+        d = self.dict()
         if d["destination_queue"]:
             d["destination_queue"] = [d["destination_queue"][0]]
         return d
 
-    async def move(self, game: Game, planets: list[Planet]):
-        if not self.destination_queue:
-            return
+    @property
+    def in_flight(self) -> bool:
+        return self.arrives_at is not None
 
-        try:
-            destination = next(
-                p for p in planets if p.id == self.destination_queue[0].planet
-            )
-        except StopIteration:
-            # destination no longer exists
-            self.destination_queue.pop(0)
-            return
+    def position_at(self, t: datetime) -> Vec:
+        """
+        where the carrier is at a point in time, worked out from its current leg
+        """
+        if not self.in_flight:
+            return Vec.of(self.position)
+
+        departed_at, arrives_at = as_utc(self.departed_at), as_utc(self.arrives_at)
+        leg = (arrives_at - departed_at).total_seconds()
+        done = (t - departed_at).total_seconds() / leg if leg > 0 else 1
+        done = min(1, max(0, done))
 
-        distance_to_move = distance(
-            (self.position.x, self.position.y),
-            (destination.position.x, destination.position.y),
+        return Vec(
+            self.position.x + (self.target.x - self.position.x) * done,
+            self.position.y + (self.target.y - self.position.y) * done,
         )
 
+    def depart(self, game: Game, planets: "dict[str, Planet]", now: datetime) -> bool:
+        """
+        set off towards the next destination from where the carrier is now.
+        returns whether it is flying
+        """
+        start = self.position_at(now)
+        self.position = start.to_position()
+        self.target = self.departed_at = self.arrives_at = None
+
+        while self.destination_queue:
+            destination = planets.get(self.destination_queue[0].planet)
+            if destination:
+                break
+            # destination no longer exists
+            self.destination_queue.pop(0)
+        else:
+            return False
+
         speed = game.settings.carrier_speed
         if destination.warp_gate:
             speed = game.settings.warp_speed
 
-        speed = speed / 60  # because we are running this every minute
+        speed = speed / 60  # light years per minute
 
-        if distance_to_move <= speed:
-            self.position = destination.position
-            popped = self.destination_queue.pop(0)
+        # the planet keeps orbiting while we fly, so aim for where it will be
+        # when we get there. it moves slower than us so this settles quickly
+        minutes = distance(start, destination.position) / speed
+        for _ in range(8):
+            target = destination.position_at(game, now + timedelta(minutes=minutes))
+            minutes = distance(start, target) / speed
 
-            if popped.action == "collect" and destination.occupier == self.owner:
-                self.ships += destination.ships
-                await destination.set({Planet.ships: 0})
-            elif (
-                popped.action == "drop"
-                and self.ships > 1
-                and destination.occupier == self.owner
-            ):
-                await destination.inc({Planet.ships: self.ships - 1})
-                self.ships = 1
+        self.target = target.to_position()
+        self.departed_at = now
+        self.arrives_at = now + timedelta(minutes=minutes)
+        return True
 
-        else:
-            direction = (
-                (destination.position.x - self.position.x) / distance_to_move,
-                (destination.position.y - self.position.y) / distance_to_move,
-            )
-
-            self.position.x += direction[0] * speed
-            self.position.y += direction[1] * speed
+    def arrive(self, destination: Planet):
+        """
+        land on the next destination and carry out its action
+        """
+        self.position = destination.position.to_position()
+        self.target = self.departed_at = self.arrives_at = None
+        popped = self.destination_queue.pop(0)
+
+        if popped.action == "collect" and destination.occupier == self.owner:
+            self.ships += destination.ships
+            destination.ships = 0
+        elif (
+            popped.action == "drop"
+            and self.ships > 1
+            and destination.occupier == self.owner
+        ):
+            destination.ships += self.ships - 1
+            self.ships = 1
 
     class Settings:
         name = "carriers"
@@ -705,6 +844,50 @@ class Census(Document):
         use_state_management = True
 
 
+class Lease(Document):
+    """
+    Time limited claim on something that only one backend instance should do
+    at a time, like ticking a game. Instances also keep a lease on themselves
+    as a heartbeat so the others know who is alive.
+    """
+
+    id: str  # what is being leased, e.g. a game id or "instance:<id>"
+    holder: str
+    # fly machine the holder runs on, so requests can be replayed to it
+    machine: Optional[str] = Field(default=None)
+    kind: str = Field(default="game")  # game, instance
+    expires_at: datetime
+
+    class Settings:
+        name = "leases"
+        indexes = [
+            # mongo only sweeps these about once a minute, so expiry is also checked when acquiring
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+        ]
+
+
+class Relay(Document):
+    """
+    Galaxy scan on its way to a player whose gateway connection lives on
+    another instance than the one ticking their game. Whoever holds the socket
+    picks these up and sends them on.
+    """
+
+    id: str = Field(default_factory=generate_id)
+    instance: str  # holder of the socket
+    user: str
+    scan: dict
+    created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
+
+    class Settings:
+        name = "relays"
+        indexes = [
+            IndexModel([("instance", ASCENDING)]),
+            # a scan nobody picked up in time is stale anyway
+            IndexModel([("created_at", ASCENDING)], expireAfterSeconds=60),
+        ]
+
+
 async def init():
     global client
     client = AsyncIOMotorClient(getenv("MONGO_URL"))
@@ -721,6 +904,8 @@ async def init():
             News,
             Planet,
             Census,
+            Lease,
+            Relay,
         ],
     )
     print("Connected to MongoDB", important=True)
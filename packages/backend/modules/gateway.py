@@ -2,6 +2,7 @@ from sanic import Websocket
 from modules import utils
 import asyncio
 from enum import Enum
+from os import getenv
 
 
 class GatewayOpCode(Enum):
@@ -20,24 +21,58 @@ class GatewayOpCode(Enum):
     USER_UPDATE = 12
     REQUEST_CHANNELS = 13
     GALAXY_SCAN = 14
+    GALAXY_SCAN_DELTA = 15
+    GALAXY_SCAN_ACK = 16
 
 
 GATEWAY_CONNECTIONS: dict[str, Websocket] = {}
 
+# how many sent scans are kept around per player and game to diff against
+SCAN_HISTORY = int(getenv("SCAN_HISTORY", 4))
+SCAN_COLLECTIONS = ("players", "stars", "planets", "carriers")
+
+
+class ScanSession:
+    """
+    The scans sent to one connection for one game, so the next one can go out
+    as a diff against whatever the client last acknowledged having.
+    """
+
+    def __init__(self):
+        self.seq = 0
+        # seq -> collection -> entity id -> entity, for the last few scans sent
+        self.sent: dict[int, dict[str, dict[str, dict]]] = {}
+        # clients that never ack (older ones) keep getting full scans
+        self.acked: int | None = None
+
+    def prune(self):
+        for seq in list(self.sent):
+            if seq != self.acked and seq <= self.seq - SCAN_HISTORY:
+                del self.sent[seq]
+
+
+SCAN_SESSIONS: dict[tuple[str, str], ScanSession] = {}
+
 
 def add_websocket_connection(user_id: str, websocket: Websocket):
     global GATEWAY_CONNECTIONS
     GATEWAY_CONNECTIONS[user_id] = websocket
+    _drop_scan_sessions(user_id)
 
 
 def remove_websocket_connection(user_id: str):
     global GATEWAY_CONNECTIONS
+    _drop_scan_sessions(user_id)
     if user_id in GATEWAY_CONNECTIONS:
         ws = GATEWAY_CONNECTIONS[user_id]
         del GATEWAY_CONNECTIONS[user_id]
         asyncio.create_task(ws.close())
 
 
+def is_connected(user_id: str) -> bool:
+    return user_id in GATEWAY_CONNECTIONS
+
+
 def send_to_user(user_id: str, op: GatewayOpCode, data: dict | None = None):
     global GATEWAY_CONNECTIONS
     if user_id in GATEWAY_CONNECTIONS:
@@ -65,3 +100,107 @@ def send_to_all(op: GatewayOpCode, data: dict | None = None):
 
     if tasks:
         return asyncio.gather(*tasks)
+
+
+def _drop_scan_sessions(user_id: str):
+    # a new connection starts from a full scan
+    for key in [key for key in SCAN_SESSIONS if key[0] == user_id]:
+        del SCAN_SESSIONS[key]
+
+
+def _index_scan(scan: dict) -> dict[str, dict[str, dict]]:
+    return {key: {e["id"]: e for e in scan[key]} for key in SCAN_COLLECTIONS}
+
+
+def _full_scan(game_id: str, seq: int, index: dict[str, dict[str, dict]]) -> dict:
+    return {
+        "game": game_id,
+        "seq": seq,
+        **{key: list(index[key].values()) for key in SCAN_COLLECTIONS},
+    }
+
+
+def diff_entities(old: dict[str, dict], new: dict[str, dict]) -> dict:
+    """
+    What it takes to turn one collection of a scan into another. changed has
+    new entities in full and only the differing fields (plus id) of existing
+    ones, dropped lists fields an entity no longer has, and removed the ids of
+    entities that are gone.
+    """
+    changed, dropped = [], {}
+    for entity_id, entity in new.items():
+        before = old.get(entity_id)
+        if before is None:
+            changed.append(entity)
+            continue
+
+        fields = {k: v for k, v in entity.items() if k not in before or before[k] != v}
+        if fields:
+            fields["id"] = entity_id
+            changed.append(fields)
+        if gone := [k for k in before if k not in entity]:
+            dropped[entity_id] = gone
+
+    return {
+        "changed": changed,
+        "dropped": dropped,
+        "removed": [entity_id for entity_id in old if entity_id not in new],
+    }
+
+
+def send_scan(user_id: str, scan: dict):
+    """
+    Send a galaxy scan, as a diff against the last one the client acknowledged
+    if it has acknowledged any, or in full otherwise. Every scan carries a seq
+    for the client to ack with GALAXY_SCAN_ACK.
+    """
+    if not is_connected(user_id):
+        return
+
+    game_id = scan["game"]
+    session = SCAN_SESSIONS.setdefault((user_id, game_id), ScanSession())
+    session.seq += 1
+    index = _index_scan(scan)
+
+    if (base := session.sent.get(session.acked)) is not None:
+        op = GatewayOpCode.GALAXY_SCAN_DELTA
+        data = {
+            "game": game_id,
+            "seq": session.seq,
+            "base": session.acked,
+            **{key: diff_entities(base[key], index[key]) for key in SCAN_COLLECTIONS},
+        }
+    else:
+        op = GatewayOpCode.GALAXY_SCAN
+        data = {**scan, "seq": session.seq}
+
+    session.sent[session.seq] = index
+    session.prune()
+    return send_to_user(user_id, op, data)
+
+
+def ack_scan(user_id: str, game_id: str, seq: int | None):
+    """
+    The client has the scan with this seq. Anything it can't place (no seq,
+    or one too old to still be around) means it lost track, so it gets the
+    latest scan again in full.
+    """
+    if not (session := SCAN_SESSIONS.get((user_id, game_id))):
+        return
+
+    if seq is not None and session.acked is not None and seq <= session.acked:
+        # late ack for something older than what we already know it has
+        return
+
+    if seq in session.sent:
+        session.acked = seq
+        session.prune()
+        return
+
+    session.acked = None
+    if latest := session.sent.get(session.seq):
+        send_to_user(
+            user_id,
+            GatewayOpCode.GALAXY_SCAN,
+            _full_scan(game_id, session.seq, latest),
+        )
@@ -0,0 +1,143 @@
+import asyncio
+import os
+import struct
+import zlib
+from os import getenv
+
+import bson
+
+from modules.bulk import WriteCollector
+from modules.db import Carrier, Game, Planet, Player, as_utc
+from modules.utils import print
+
+# where tick journals go, unset turns journaling off
+JOURNAL_DIR = getenv("TICK_JOURNAL_DIR")
+# fsync every record. off leaves it to the os, which survives a process crash
+# but not the machine going down
+JOURNAL_FSYNC = getenv("TICK_JOURNAL_FSYNC", "1") not in ("0", "false", "off")
+
+MODELS = {model.__name__: model for model in (Planet, Player, Carrier)}
+
+# every record is its length and crc32 followed by that many bytes of bson
+_HEADER = struct.Struct("<II")
+
+
+def _path(game_id: str) -> str:
+    return os.path.join(JOURNAL_DIR, f"{game_id}.journal")
+
+
+def encode(record: dict) -> bytes:
+    payload = bson.encode(record)
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode(data: bytes) -> list[dict]:
+    """
+    every intact record in a journal, stopping at the first torn or corrupt one
+    """
+    records = []
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        length, crc = _HEADER.unpack_from(data, offset)
+        payload = data[offset + _HEADER.size : offset + _HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+
+        records.append(bson.decode(payload))
+        offset += _HEADER.size + length
+    return records
+
+
+def _append(path: str, data: bytes):
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    with open(path, "ab") as f:
+        f.write(data)
+        f.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(f.fileno())
+
+
+async def append(game_id: str, record: dict):
+    if not JOURNAL_DIR:
+        return
+
+    await asyncio.to_thread(_append, _path(game_id), encode(record))
+
+
+def _rewrite(path: str, data: bytes):
+    # write it next to the old one and swap, so a crash leaves one or the other
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+async def rewrite(game_id: str, record: dict):
+    """
+    replace a game's journal with a single record, for when what it holds is out
+    of date
+    """
+    if not JOURNAL_DIR:
+        return
+
+    await asyncio.to_thread(_rewrite, _path(game_id), encode(record))
+
+
+def discard(game_id: str):
+    """
+    throw a game's journal away, once it's flushed or the game is somebody else's
+    """
+    if not JOURNAL_DIR:
+        return
+
+    try:
+        os.remove(_path(game_id))
+    except FileNotFoundError:
+        pass
+
+
+async def _replay(game_id: str, record: dict) -> int:
+    game = await Game.get(game_id)
+    last_tick_at = record["game"].get("last_tick_at")
+    if (
+        not game
+        or not last_tick_at
+        or (game.last_tick_at and as_utc(game.last_tick_at) >= as_utc(last_tick_at))
+    ):
+        # mongo is already at or past this point, someone else ticked it on
+        return 0
+
+    writes = WriteCollector()
+    for update in record["updates"]:
+        writes.set(MODELS[update["model"]], update["id"], update["set"])
+    writes.delete(Carrier, record["deleted_carriers"])
+    writes.set(Game, game_id, record["game"])
+    return await writes.commit()
+
+
+async def replay():
+    """
+    Write back whatever ticks were journaled but never flushed before the last
+    shutdown. Each record holds everything pending since the last flush, so
+    only the newest intact one matters. Runs before any game is loaded.
+    """
+    if not JOURNAL_DIR:
+        return
+
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    for name in os.listdir(JOURNAL_DIR):
+        if not name.endswith(".journal"):
+            continue
+
+        game_id = name.removesuffix(".journal")
+        with open(_path(game_id), "rb") as f:
+            records = decode(f.read())
+
+        if records:
+            ops = await _replay(game_id, records[-1])
+            print(f"Replayed journal for game {game_id}: {ops} writes", important=True)
+
+        discard(game_id)
@@ -0,0 +1,218 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from os import getenv
+
+import numpy as np
+
+from modules.db import (
+    Carrier,
+    GameSettings,
+    Planet,
+    Player,
+    SpatialGrid,
+    Star,
+    as_utc,
+)
+
+# worker processes the galaxy-wide kernels run in, 0 runs them on the event loop
+TICK_PROCESSES = max(0, int(getenv("TICK_PROCESSES", 0)))
+
+_pool: ProcessPoolExecutor | None = None
+
+
+class PlanetArrays:
+    """
+    Struct-of-arrays copy of a game's planets so orbits and production can be
+    advanced for the whole galaxy in a handful of array operations.
+
+    Orbits are a function of time, so their parameters live across ticks and
+    positions are worked out from them. Ships, industry and ownership are also
+    changed by the API and by combat, so they are gathered from the documents
+    at the start of every tick.
+    """
+
+    def __init__(self, planets: list[Planet], stars: list[Star]):
+        stars_by_id = {s.id: s for s in stars}
+        n = len(planets)
+
+        self.planets = planets
+        self.theta = np.fromiter((p.theta for p in planets), np.float64, n)
+        self.epoch = np.fromiter(
+            (as_utc(p.epoch).timestamp() for p in planets), np.float64, n
+        )
+        self.radius = np.fromiter((p.distance for p in planets), np.float64, n)
+        self.star_x = np.fromiter(
+            (stars_by_id[p.orbits].position.x for p in planets), np.float64, n
+        )
+        self.star_y = np.fromiter(
+            (stars_by_id[p.orbits].position.y for p in planets), np.float64, n
+        )
+
+        # where the planets were last placed
+        self.x = np.fromiter((p.position.x for p in planets), np.float64, n)
+        self.y = np.fromiter((p.position.y for p in planets), np.float64, n)
+
+        self.industry = np.zeros(n, np.float64)
+        self.ships = np.zeros(n, np.int64)
+        self.ship_accum = np.zeros(n, np.float64)
+        self.manufacturing = np.full(n, -1, np.int64)  # -1 means unowned
+
+    def gather(self, members: list[Player]):
+        manufacturing = {p.id: p.research_levels.manufacturing for p in members}
+        n = len(self.planets)
+
+        self.industry = np.fromiter((p.industry for p in self.planets), np.float64, n)
+        self.ships = np.fromiter((p.ships for p in self.planets), np.int64, n)
+        self.ship_accum = np.fromiter(
+            (p.ship_accum for p in self.planets), np.float64, n
+        )
+        self.manufacturing = np.fromiter(
+            (manufacturing.get(p.occupier, -1) for p in self.planets), np.int64, n
+        )
+
+    def __getstate__(self):
+        # only the arrays get sent to worker processes, never the documents
+        state = self.__dict__.copy()
+        state["planets"] = None
+        return state
+
+    def changes(self) -> dict[str, np.ndarray]:
+        return {
+            "x": self.x,
+            "y": self.y,
+            "ships": self.ships,
+            "ship_accum": self.ship_accum,
+        }
+
+    def apply(self, changes: dict[str, np.ndarray]):
+        for name, values in changes.items():
+            setattr(self, name, values)
+
+    def scatter(self):
+        """
+        write the kernel results back onto the planet documents
+        """
+        for planet, px, py, ships, ship_accum in zip(
+            self.planets,
+            self.x.tolist(),
+            self.y.tolist(),
+            self.ships.tolist(),
+            self.ship_accum.tolist(),
+        ):
+            planet.position.x = px
+            planet.position.y = py
+            planet.ships = ships
+            planet.ship_accum = ship_accum
+
+
+def place_planets(arrays: PlanetArrays, settings: GameSettings, t: float):
+    """
+    move every planet to where its orbit has it at t. the distance travelled
+    along the orbit is based on speed, not a fixed angle
+    """
+    minutes = (t - arrays.epoch) / 60
+    theta = arrays.theta + settings.orbit_speed * minutes / arrays.radius
+    arrays.x = arrays.star_x + arrays.radius * np.cos(theta)
+    arrays.y = arrays.star_y + arrays.radius * np.sin(theta)
+
+
+def advance_production(
+    arrays: PlanetArrays, settings: GameSettings, minutes: float = 1
+):
+    """
+    produces ships via industry * (occupier.manufacturing + 5) / game production length
+    """
+    owned = arrays.manufacturing >= 0
+    arrays.ship_accum += np.where(
+        owned,
+        arrays.industry
+        * (arrays.manufacturing + 5)
+        / settings.production_cycle_length
+        / 60
+        * minutes,
+        0,
+    )
+
+    produced = np.floor(arrays.ship_accum)
+    arrays.ships += produced.astype(np.int64)
+    arrays.ship_accum -= produced
+
+
+def compute_planets(
+    arrays: PlanetArrays, settings: GameSettings, t: float, minutes: float = 1
+) -> dict[str, np.ndarray]:
+    """
+    the pure part of a planet tick. in a worker process this runs on a copy of
+    the arrays, so only the change set comes back
+    """
+    advance_production(arrays, settings, minutes)
+    place_planets(arrays, settings, t)
+    return arrays.changes()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawned, forking a process with a running event loop isn't safe
+        _pool = ProcessPoolExecutor(
+            max_workers=TICK_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+async def tick_planets(
+    arrays: PlanetArrays, settings: GameSettings, t: float, minutes: float = 1
+):
+    """
+    produce ships and move planets along their orbits to t, off the event loop
+    when TICK_PROCESSES is set so a big galaxy doesn't hold up everyone else
+    """
+    if not TICK_PROCESSES:
+        compute_planets(arrays, settings, t, minutes)
+        return
+
+    changes = await asyncio.get_running_loop().run_in_executor(
+        _get_pool(), compute_planets, arrays, settings, t, minutes
+    )
+    arrays.apply(changes)
+
+
+def drag_parked_carriers(
+    arrays: PlanetArrays,
+    old_x: np.ndarray,
+    old_y: np.ndarray,
+    carriers: list[Carrier],
+) -> list[Carrier]:
+    """
+    move carriers sitting on a planet along with it. returns the moved carriers
+    """
+    parked = [c for c in carriers if not c.in_flight]
+    if not parked:
+        return []
+
+    old_x, old_y = old_x.tolist(), old_y.tolist()
+    grid = SpatialGrid(
+        range(len(arrays.planets)), key=lambda i: (old_x[i], old_y[i])
+    )
+    new_x, new_y = arrays.x, arrays.y
+
+    moved = []
+    for carrier in parked:
+        if not (nearby := grid.query(carrier.position, 0.01)):
+            continue
+
+        i = nearby[0]
+        carrier.position.x = float(new_x[i])
+        carrier.position.y = float(new_y[i])
+        moved.append(carrier)
+
+    return moved
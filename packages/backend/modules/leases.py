@@ -0,0 +1,161 @@
+import hashlib
+from datetime import datetime, timedelta, UTC
+from os import getenv, getpid
+
+from beanie.operators import In
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from modules.db import Lease
+from modules.utils import generate_id, print
+
+# on fly this lets other machines replay requests straight to us
+MACHINE_ID = getenv("FLY_MACHINE_ID")
+# leases are held per process, every sanic worker on a machine is its own instance
+INSTANCE_ID = f"{MACHINE_ID or generate_id()}:{getpid()}"
+LEASE_SECONDS = int(getenv("TICK_LEASE_SECONDS", 150))
+
+# game leases this instance currently holds
+HELD: set[str] = set()
+
+
+class NotLeader(Exception):
+    """
+    Raised when another instance holds the lease for a game, so its resident
+    state lives over there.
+    """
+
+    def __init__(self, key: str, lease: Lease | None):
+        super().__init__(f"{key} is leased by {lease.holder if lease else None}")
+        self.key = key
+        self.holder = lease.holder if lease else None
+        self.machine = lease.machine if lease else None
+
+
+def _expiry() -> datetime:
+    return datetime.now(UTC) + timedelta(seconds=LEASE_SECONDS)
+
+
+async def acquire(key: str, kind: str = "game") -> bool:
+    """
+    take or renew the lease on key. fails if someone else holds a live lease on it
+    """
+    try:
+        lease = await Lease.get_motor_collection().find_one_and_update(
+            {
+                "_id": key,
+                "$or": [
+                    {"holder": INSTANCE_ID},
+                    {"expires_at": {"$lt": datetime.now(UTC)}},
+                ],
+            },
+            {
+                "$set": {
+                    "holder": INSTANCE_ID,
+                    "machine": MACHINE_ID,
+                    "kind": kind,
+                    "expires_at": _expiry(),
+                }
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # the lease exists and is live, but isn't ours
+        return False
+
+    acquired = lease is not None and lease["holder"] == INSTANCE_ID
+    if acquired and kind == "game":
+        HELD.add(key)
+    return acquired
+
+
+async def claim(key: str, kind: str):
+    """
+    take the lease on key whether or not someone else holds it, for things the
+    newest instance to ask should own
+    """
+    await Lease.get_motor_collection().update_one(
+        {"_id": key},
+        {
+            "$set": {
+                "holder": INSTANCE_ID,
+                "machine": MACHINE_ID,
+                "kind": kind,
+                "expires_at": _expiry(),
+            }
+        },
+        upsert=True,
+    )
+
+
+async def release(key: str):
+    HELD.discard(key)
+    await Lease.find(Lease.id == key, Lease.holder == INSTANCE_ID).delete_many()
+
+
+async def release_all():
+    keys = list(HELD)
+    HELD.clear()
+    await Lease.find(In(Lease.id, keys), Lease.holder == INSTANCE_ID).delete_many()
+
+
+async def extend(keys: list[str]):
+    """
+    push back the expiry on whichever of these leases we hold
+    """
+    await Lease.find(In(Lease.id, keys), Lease.holder == INSTANCE_ID).update_many(
+        {"$set": {"expires_at": _expiry()}}
+    )
+
+
+async def renew_all() -> set[str]:
+    """
+    push back the expiry on every held game lease. returns the ones we lost
+    """
+    if not HELD:
+        return set()
+
+    keys = list(HELD)
+    await extend(keys)
+    still_held = await Lease.find(
+        In(Lease.id, keys), Lease.holder == INSTANCE_ID
+    ).to_list(None)
+
+    lost = set(keys) - {lease.id for lease in still_held}
+    if lost:
+        print(f"Lost {len(lost)} game leases", important=True)
+    HELD.difference_update(lost)
+    return lost
+
+
+async def get_lease(key: str) -> Lease | None:
+    """
+    the live lease on key, if anyone has one
+    """
+    return await Lease.find_one(Lease.id == key, Lease.expires_at > datetime.now(UTC))
+
+
+async def heartbeat() -> list[str]:
+    """
+    keep this instance's own lease alive. returns every live instance
+    """
+    await acquire(f"instance:{INSTANCE_ID}", kind="instance")
+    instances = await Lease.find(
+        Lease.kind == "instance", Lease.expires_at > datetime.now(UTC)
+    ).to_list(None)
+    return sorted(lease.holder for lease in instances)
+
+
+def is_assigned(key: str, instances: list[str]) -> bool:
+    """
+    rendezvous hashing, so games spread evenly over instances and only the games
+    of an instance that comes or goes change hands
+    """
+    if not instances:
+        return True
+
+    return INSTANCE_ID == max(
+        instances,
+        key=lambda instance: hashlib.sha1(f"{key}:{instance}".encode()).digest(),
+    )
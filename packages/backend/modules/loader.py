@@ -0,0 +1,65 @@
+import asyncio
+from collections import defaultdict
+
+from beanie import Link
+from beanie.operators import In
+
+from modules.db import Carrier, Game, Planet, Player, Star
+
+
+def _resolve(links: list, docs: dict) -> list:
+    # keep the link order, dropping anything that no longer exists
+    resolved = []
+    for link in links:
+        doc = docs.get(link.ref.id) if isinstance(link, Link) else link
+        if doc is not None:
+            resolved.append(doc)
+    return resolved
+
+
+async def load_members(games: list[Game]):
+    """
+    resolve the members of a batch of games with one query, instead of a
+    $lookup per game
+    """
+    if not games:
+        return
+
+    players = await Player.find(In(Player.game, [g.id for g in games])).to_list(None)
+    players_by_id = {p.id: p for p in players}
+    for game in games:
+        game.members = _resolve(game.members, players_by_id)
+
+
+async def find_games(*criteria) -> list[Game]:
+    games = await Game.find(*criteria).to_list(None)
+    await load_members(games)
+    return games
+
+
+async def load_galaxies(
+    game_ids: list[str],
+) -> tuple[dict[str, list[Star]], dict[str, list[Carrier]]]:
+    """
+    Fetch the stars, planets and carriers of a batch of games with one query per
+    collection and split them up by game in memory.
+
+    returns (stars by game, carriers by game)
+    """
+    stars, planets, carriers = await asyncio.gather(
+        Star.find(In(Star.game, game_ids)).to_list(None),
+        Planet.find(In(Planet.game, game_ids)).to_list(None),
+        Carrier.find(In(Carrier.game, game_ids)).to_list(None),
+    )
+    planets_by_id = {p.id: p for p in planets}
+
+    stars_by_game: dict[str, list[Star]] = defaultdict(list)
+    for star in stars:
+        star.planets = _resolve(star.planets, planets_by_id)
+        stars_by_game[star.game].append(star)
+
+    carriers_by_game: dict[str, list[Carrier]] = defaultdict(list)
+    for carrier in carriers:
+        carriers_by_game[carrier.game].append(carrier)
+
+    return stars_by_game, carriers_by_game
@@ -72,22 +72,25 @@ OUTLET_NAMES = [
 ]
 
 
-async def create_article(game: Game, event: Event, planets: list[Planet]):
+def get_player_strings(
+    game: Game, planet_counts: dict[str, int], total_planets: int
+) -> list[str]:
+    return [
+        f"{player.name} - {planet_counts.get(player.id, 0)}/{total_planets} planets"
+        for player in game.members
+    ]
+
+
+async def create_article(
+    game: Game, event: Event, planet_counts: dict[str, int], total_planets: int
+):
     if not getenv("OPENAI_TOKEN", None):
         print("No OpenAI token set, skipping article generation")
         return
 
-    player_strings = []
+    player_strings = get_player_strings(game, planet_counts, total_planets)
     outlet = random.choice(OUTLET_NAMES)
 
-    for player in game.members:
-        player_planets = len(
-            list(filter(lambda planet: planet.occupier == player.id, planets))
-        )
-        player_strings.append(
-            f"{player.name} - {player_planets}/{len(planets)} planets"
-        )
-
     print(f"Generating article for event: {event.type}")
 
     # fetch past events for context
@@ -149,22 +152,16 @@ async def create_article(game: Game, event: Event, planets: list[Planet]):
     return article
 
 
-async def create_misc_article(game: Game, planets: list[Planet]):
+async def create_misc_article(
+    game: Game, planet_counts: dict[str, int], total_planets: int
+):
     if not getenv("OPENAI_TOKEN", None):
         print("No OpenAI token set, skipping article generation")
         return
 
-    player_strings = []
+    player_strings = get_player_strings(game, planet_counts, total_planets)
     outlet = random.choice(OUTLET_NAMES)
 
-    for player in game.members:
-        player_planets = len(
-            list(filter(lambda planet: planet.occupier == player.id, planets))
-        )
-        player_strings.append(
-            f"{player.name} - {player_planets}/{len(planets)} planets"
-        )
-
     topic = random.choice(OFF_NEWS_CYCLE_TOPICS)
 
     print(f"Generating off-cycle article about: {topic}")
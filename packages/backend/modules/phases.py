@@ -0,0 +1,51 @@
+import asyncio
+from typing import Awaitable, Callable
+
+
+class Phase:
+    """
+    One step of a tick, with the parts of the game it reads and writes so it
+    can be run alongside any other step that doesn't touch the same things.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[..., Awaitable],
+        reads: set[str] = frozenset(),
+        writes: set[str] = frozenset(),
+    ):
+        self.name = name
+        self.run = run
+        self.reads = set(reads)
+        self.writes = set(writes)
+
+    def depends_on(self, other: "Phase") -> bool:
+        return bool(
+            other.writes & (self.reads | self.writes) or self.writes & other.reads
+        )
+
+
+async def _run_phase(phase: Phase, after: list[asyncio.Task], args, kwargs):
+    # if something this needs failed, so does this
+    await asyncio.gather(*after)
+    await phase.run(*args, **kwargs)
+
+
+async def run_phases(phases: list[Phase], *args, **kwargs):
+    """
+    Run phases as a dependency graph. A phase waits for every phase before it
+    in the list that writes something it reads or writes (or reads something
+    it writes), and everything else runs at the same time, so one phase's I/O
+    overlaps with another's work. Returns once all of them are done, raising
+    the first error.
+    """
+    tasks: list[asyncio.Task] = []
+    for i, phase in enumerate(phases):
+        after = [tasks[j] for j in range(i) if phase.depends_on(phases[j])]
+        tasks.append(asyncio.create_task(_run_phase(phase, after, args, kwargs)))
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta, UTC
+
+from modules.db import Game
+from modules import loader
+from modules.utils import print
+
+# games that have started and nobody has won yet, with their rosters
+ACTIVE_GAMES: dict[str, Game] = {}
+
+_refreshed_at: datetime | None = None
+
+# how far back to look for games started by other instances, to cover clock skew
+REFRESH_OVERLAP = timedelta(minutes=2)
+
+
+def track(game: Game):
+    """
+    keep the registry's copy of a game up to date after it is started,
+    restarted, joined or won
+    """
+    if game.started_at and not game.winner:
+        ACTIVE_GAMES[game.id] = game
+    else:
+        ACTIVE_GAMES.pop(game.id, None)
+
+
+def forget(game_id: str):
+    ACTIVE_GAMES.pop(game_id, None)
+
+
+def get_game(game_id: str) -> Game | None:
+    return ACTIVE_GAMES.get(game_id)
+
+
+def active_games() -> list[Game]:
+    return list(ACTIVE_GAMES.values())
+
+
+async def load():
+    global _refreshed_at
+    _refreshed_at = datetime.now(UTC)
+
+    games = await loader.find_games(Game.started_at != None, Game.winner == None)
+
+    ACTIVE_GAMES.clear()
+    for game in games:
+        track(game)
+
+    print(f"Loaded {len(ACTIVE_GAMES)} active games")
+
+
+async def refresh():
+    """
+    Pick up games that were started or restarted through another instance since
+    the last look. Only games started since then are fetched, so this stays an
+    index range scan however many games there are.
+    """
+    global _refreshed_at
+    if _refreshed_at is None:
+        return await load()
+
+    since = _refreshed_at - REFRESH_OVERLAP
+    _refreshed_at = datetime.now(UTC)
+
+    games = await loader.find_games(Game.started_at > since, Game.winner == None)
+    for game in games:
+        if game.id not in ACTIVE_GAMES:
+            print(f"Picked up game ({game.name}) {game.id}")
+        track(game)
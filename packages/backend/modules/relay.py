@@ -0,0 +1,85 @@
+import asyncio
+import time
+from datetime import datetime, UTC
+from os import getenv
+
+from beanie.operators import In
+
+from modules import gateway, leases
+from modules.db import Lease, Relay
+from modules.utils import print
+
+# how often to check for scans other instances left for our sockets
+RELAY_POLL_SECONDS = float(getenv("RELAY_POLL_SECONDS", 1))
+
+_renewed_at = 0.0
+
+
+def _key(user_id: str) -> str:
+    return f"socket:{user_id}"
+
+
+async def connected(user_id: str):
+    """
+    let the other instances know this user's gateway connection is ours now,
+    the newest connection wins just like it does locally
+    """
+    await leases.claim(_key(user_id), kind="socket")
+
+
+async def disconnected(user_id: str):
+    await leases.release(_key(user_id))
+
+
+async def holders(user_ids: list[str]) -> dict[str, str]:
+    """
+    which other instance holds the socket of each of these users, if any does
+    """
+    if not user_ids:
+        return {}
+
+    sockets = await Lease.find(
+        In(Lease.id, [_key(user_id) for user_id in user_ids]),
+        Lease.holder != leases.INSTANCE_ID,
+        Lease.expires_at > datetime.now(UTC),
+    ).to_list(None)
+    return {lease.id.removeprefix("socket:"): lease.holder for lease in sockets}
+
+
+async def forward(relays: list[Relay]):
+    if relays:
+        await Relay.insert_many(relays)
+
+
+async def deliver() -> int:
+    """
+    Send on the scans left for our sockets. Only the newest per player and game
+    matters, it's diffed against whatever the connection last acked here.
+    """
+    relays = await Relay.find(Relay.instance == leases.INSTANCE_ID).to_list(None)
+    if not relays:
+        return 0
+
+    await Relay.find(In(Relay.id, [r.id for r in relays])).delete_many()
+
+    latest: dict[tuple[str, str], Relay] = {}
+    for relay in sorted(relays, key=lambda r: r.created_at):
+        latest[relay.user, relay.scan["game"]] = relay
+
+    for relay in latest.values():
+        gateway.send_scan(relay.user, relay.scan)
+    return len(latest)
+
+
+async def run():
+    global _renewed_at
+    while True:
+        await asyncio.sleep(RELAY_POLL_SECONDS)
+        try:
+            if time.time() - _renewed_at > leases.LEASE_SECONDS / 3:
+                if users := list(gateway.GATEWAY_CONNECTIONS):
+                    await leases.extend([_key(user_id) for user_id in users])
+                _renewed_at = time.time()
+            await deliver()
+        except Exception as e:
+            print(f"Relaying scans failed: {e}", important=True)
@@ -1,84 +1,426 @@
 import asyncio
+from datetime import datetime, UTC
+import functools
+import hashlib
 import random
 import time
 import aiocron
+from beanie.operators import In
+from os import getenv
 
 from blueprints.scan import on_scan
-from modules.db import Carrier, Census, Game, PlayerCensus, Star
-from modules import newsgen
+from modules.db import Census, Game, PlayerCensus, as_utc
+from modules.kernels import drag_parked_carriers, tick_planets
+from modules.phases import Phase, run_phases
+from modules.state import (
+    GameState,
+    TickContext,
+    abandon_state,
+    drop_state,
+    get_state,
+    load_states,
+)
+from modules import leases, loader, newsgen, registry
 from modules.utils import print
 from blueprints.planets import planet_tick
-from blueprints.carriers import carrier_tick
+from blueprints.carriers import carrier_tick, fight, land_carriers
 from blueprints.players import player_tick
 
 
-async def game_tick(game: Game, hourly=False):
-    print(f"Game tick ({game.name}) {game.id}")
-    stars = await Star.find(Star.game == game.id, fetch_links=True).to_list(None)
-    carriers = await Carrier.find(Carrier.game == game.id).to_list(None)
-    planets = [p for s in stars for p in s.planets]
-    await planet_tick(game, stars, carriers, hourly=hourly)
-    await carrier_tick(game, stars, carriers, hourly=hourly)
-    await player_tick(game, stars, hourly=hourly)
+def missed_hourly_ticks(game_id: str, since: float, until: float) -> list:
+    """
+    the hourly ticks a game should have had strictly between two tick times
+    """
+    second, minute = tick_offsets(game_id)
+    t = since // 3600 * 3600 + minute * 60 + second
+
+    missed = []
+    while t < until:
+        if t > since:
+            missed.append(time.gmtime(t))
+        t += 3600
+    return missed
+
+
+async def fast_forward(
+    state: GameState, ctx: TickContext, since: float, until: float
+):
+    """
+    Catch a game up on the ticks it missed while no instance was running it,
+    working out the whole gap at once instead of replaying it minute by minute.
+    Planets are put where their orbits have them, production and economy scale
+    with the time missed, research and production payouts happen once per missed
+    hourly tick, carriers fly their whole route and battles are fought where
+    they end up.
+    """
+    game = state.game
+    planets = state.planets
+    minutes = round((until - since) / 60) - 1  # the tick about to run covers the last one
+    if minutes <= 0:
+        return
+
+    hours = missed_hourly_ticks(game.id, since, until)
+    print(
+        f"Fast forwarding game ({game.name}) {game.id} by {minutes} minutes ({len(hours)} hourly ticks)",
+        important=True,
+    )
+
+    for player in game.members:
+        owned = ctx.owned_planets(player.id)
+        # do_economy is per minute
+        player.cash += ctx.totals(player.id).economy / 0.25 / 60 * minutes
+        for hour in hours:
+            player.do_research(game, owned)
+            if hour.tm_hour == 2:
+                player.do_production(owned)
+    state.mark_dirty(*game.members)
+
+    arrays = state.planet_arrays
+    arrays.gather(ctx.players.values())
+    old_x, old_y = arrays.x, arrays.y
+    await tick_planets(arrays, game.settings, until, minutes)
+    moved = drag_parked_carriers(arrays, old_x, old_y, state.carriers)
+    arrays.scatter()
+    state.mark_dirty(*(p for p in planets if p.occupier), *moved)
+
+    arrived = land_carriers(state, datetime.fromtimestamp(until, UTC), chain=True)
+    await fight(state, ctx, arrived)
+
+
+async def publish_news(state: GameState, ctx: TickContext):
+    # writing articles means waiting on gpt, so this runs after the tick has let
+    # go of the state and never holds up requests for the game
+    for report in ctx.reports:
+        try:
+            await report()
+        except Exception as e:
+            print(f"Report for game ({state.game.name}) {state.game.id} failed: {e}")
 
     if (
         random.random() < 0.01
     ):  # 1% chance, should be on average 1 article every 100 minutes
-        await newsgen.create_misc_article(game, planets)
-
-    # every 10 minutes
-    if time.gmtime().tm_min % 10 == 0:
-        carriers = await Carrier.find(Carrier.game == game.id).to_list(None)
-        census = Census(
-            game=game.id,
-            players=[
-                PlayerCensus(
-                    player=player.id,
-                    planets=len([p for p in planets if p.occupier == player.id]),
-                    carriers=len([c for c in carriers if c.owner == player.id]),
-                    cash=int(player.cash),
-                    ships=sum([p.ships for p in planets if p.occupier == player.id])
-                    + sum([c.ships for c in carriers if c.owner == player.id]),
-                    industry=sum(
-                        [p.industry for p in planets if p.occupier == player.id]
-                    ),
-                    economy=sum(
-                        [p.economy for p in planets if p.occupier == player.id]
-                    ),
-                    science=sum(
-                        [p.science for p in planets if p.occupier == player.id]
-                    ),
-                    research_levels=player.research_levels,
-                )
-                for player in game.members
-            ],
+        await newsgen.create_misc_article(
+            state.game, state.planet_counts, len(state.planets)
         )
 
-        await census.save()
 
-        print(f"Saved census for game ({game.name}) {game.id}")
+async def take_census(state: GameState, ctx: TickContext, hourly=False):
+    game = state.game
+    ctx.invalidate()  # ships have been produced and fought over since
+    census = Census(
+        game=game.id,
+        players=[
+            PlayerCensus(
+                player=player.id,
+                planets=state.planet_counts.get(player.id, 0),
+                carriers=totals.carriers,
+                cash=int(player.cash),
+                ships=totals.ships,
+                industry=totals.industry,
+                economy=totals.economy,
+                science=totals.science,
+                research_levels=player.research_levels,
+            )
+            for player in game.members
+            if (totals := ctx.totals(player.id))
+        ],
+    )
+
+    await census.save()
+
+    print(f"Saved census for game ({game.name}) {game.id}")
+
+
+async def check_victory(state: GameState, ctx: TickContext, hourly=False):
+    game = state.game
+    if game.winner:
+        return
+
+    if winner := state.victor():
+        game.winner = winner.id
+        registry.forget(game.id)
+        print(f"{winner.name} won game ({game.name}) {game.id}", important=True)
+
+
+async def send_scans(state: GameState, ctx: TickContext, hourly=False):
+    on_scan(state.game)
+
+
+async def flush_tick(state: GameState, ctx: TickContext, hourly=False):
+    await state.tick_done()
+
+
+# news being written for ticks that are done, kept so they aren't collected
+_NEWS_TASKS: set[asyncio.Task] = set()
+
+# the order here is the order phases that touch the same things run in,
+# anything independent runs alongside
+TICK_PHASES = [
+    Phase("planets", planet_tick, reads={"players"}, writes={"planets", "carriers"}),
+    Phase(
+        "carriers",
+        carrier_tick,
+        reads={"planets", "players"},
+        writes={"planets", "carriers", "players"},
+    ),
+    Phase("players", player_tick, reads={"planets"}, writes={"players"}),
+    Phase("victory", check_victory, reads={"planets", "players"}, writes={"game"}),
+    Phase("census", take_census, reads={"planets", "carriers", "players"}),
+    Phase("scan", send_scans, reads={"planets", "carriers", "players", "game"}),
+    Phase("flush", flush_tick, reads={"planets", "carriers", "players", "game"}),
+]
+
+
+async def game_tick(game: Game, hourly=False, census=False, due: float | None = None):
+    print(f"Game tick ({game.name}) {game.id}")
+    state = await get_state(game)
+    due = due or time.time()
+
+    async with state.lock:
+        game = state.game
+        ctx = TickContext(state)
+
+        if last := game.last_tick_at:
+            await fast_forward(state, ctx, as_utc(last).timestamp(), due)
+        game.last_tick_at = datetime.fromtimestamp(due, UTC)
+
+        # every 10 minutes
+        phases = [p for p in TICK_PHASES if census or p.name != "census"]
+        await run_phases(phases, state, ctx, hourly=hourly)
+
+    task = asyncio.create_task(publish_news(state, ctx))
+    _NEWS_TASKS.add(task)
+    task.add_done_callback(_NEWS_TASKS.discard)
 
-    on_scan(game)
     print(f"finished tick for game ({game.name}) {game.id}", important=True)
 
 
-@aiocron.crontab("1-59 * * * *", start=False)
-async def games_tick():
-    print("Minutely tick", important=True)
-    games = await Game.find(
-        Game.started_at != None, Game.winner == None, fetch_links=True
-    ).to_list(None)
+# how many games can be ticking at the same time
+TICK_WORKERS = max(1, int(getenv("TICK_WORKERS", 4)))
+# how long shutting down waits on ticks that are still running
+TICK_DRAIN_TIMEOUT = float(getenv("TICK_DRAIN_TIMEOUT", 10))
 
-    for game in games:
-        asyncio.create_task(game_tick(game))
 
+class TickStats:
+    def __init__(self):
+        self.ticks = 0
+        self.skipped = 0
+        self.last_duration = 0.0  # seconds the last tick took
+        self.last_lag = 0.0  # seconds between when the last tick was due and when it started
+        self.last_wait = 0.0  # seconds the last tick sat in the queue for a worker
+        self.max_duration = 0.0
+        self.max_lag = 0.0
+        self.max_wait = 0.0
+
+
+class TickScheduler:
+    """
+    Runs game ticks on a fixed pool of workers so only so many galaxies are
+    being worked on at once, and keeps track of the tick queued or running for
+    each game so a slow tick never has another one for the same game started
+    on top of it. The queue is first come first served and a game can only be
+    in it once, so one slow game can't starve the rest.
+    """
+
+    def __init__(self, workers: int = TICK_WORKERS):
+        self.worker_count = workers
+        self.workers: list[asyncio.Task] = []
+        self.queue: asyncio.Queue | None = None
+        self.busy: set[str] = set()  # games queued or ticking
+        self.stats: dict[str, TickStats] = {}
+        self.stopping = False
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.worker_count)
+        ]
+
+    async def stop(self, timeout: float = TICK_DRAIN_TIMEOUT):
+        """
+        Let the ticks already running finish so nothing half applied gets
+        flushed. Queued ones are dropped, the next instance catches up on them.
+        """
+        self.stopping = True
+        if not self.workers:
+            return
 
-@aiocron.crontab("0 * * * *", start=False)
-async def hourly_tick():
-    print("Hourly tick", important=True)
-    games = await Game.find(
-        Game.started_at != None, Game.winner == None, fetch_links=True
-    ).to_list(None)
+        while not self.queue.empty():
+            game, *_ = self.queue.get_nowait()
+            self.busy.discard(game.id)
+            self.queue.task_done()
 
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except TimeoutError:
+            print(f"Ticks still running after {timeout}s: {self.busy}", important=True)
+
+        running = set(self.busy)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+        # cut off halfway, so keep what they had from being written back. their
+        # journals still hold the last tick that finished
+        for game_id in running:
+            abandon_state(game_id)
+
+    def schedule(
+        self, game: Game, hourly=False, census=False, due: float | None = None
+    ):
+        if self.stopping:
+            return
+
+        if not self.workers:
+            self.start()
+
+        stats = self.stats.setdefault(game.id, TickStats())
+
+        if game.id in self.busy:
+            # still busy with the last one. skip this tick, the next one that
+            # runs catches up on it, hourly work included
+            stats.skipped += 1
+            print(
+                f"Tick for game ({game.name}) {game.id} still running, skipped ({stats.skipped} total)",
+                important=True,
+            )
+            return
+
+        self.busy.add(game.id)
+        self.queue.put_nowait((game, hourly, census, due or time.time(), time.time()))
+
+    async def _worker(self):
+        while True:
+            game, hourly, census, due, queued_at = await self.queue.get()
+            try:
+                await self._run(game, hourly, census, due, queued_at)
+            finally:
+                self.busy.discard(game.id)
+                self.queue.task_done()
+
+    async def _run(
+        self, game: Game, hourly: bool, census: bool, due: float, queued_at: float
+    ):
+        stats = self.stats.setdefault(game.id, TickStats())
+        started = time.time()
+        stats.last_lag = started - due
+        stats.last_wait = started - queued_at
+        stats.max_lag = max(stats.max_lag, stats.last_lag)
+        stats.max_wait = max(stats.max_wait, stats.last_wait)
+
+        try:
+            await game_tick(game, hourly=hourly, census=census, due=due)
+        except Exception as e:
+            print(f"Tick for game ({game.name}) {game.id} failed: {e}", important=True)
+        finally:
+            stats.ticks += 1
+            stats.last_duration = time.time() - started
+            stats.max_duration = max(stats.max_duration, stats.last_duration)
+
+            print(
+                f"Tick for game ({game.name}) {game.id} took {stats.last_duration:.2f}s, {stats.last_lag:.2f}s late, {stats.last_wait:.2f}s queued"
+            )
+
+    def forget(self, game_id: str):
+        self.stats.pop(game_id, None)
+
+
+scheduler = TickScheduler()
+
+
+def minute_start() -> float:
+    return time.time() // 60 * 60
+
+
+def tick_offsets(game_id: str) -> tuple[int, int]:
+    """
+    Stable (second of the minute, minute of the hour) a game ticks on, so games
+    are spread out instead of all hitting the database at once. The minute
+    stops short of 59 so a late hourly tick still lands in the same hour.
+    """
+    digest = hashlib.sha1(game_id.encode()).digest()
+    return (
+        int.from_bytes(digest[:4], "big") % 60,
+        int.from_bytes(digest[4:8], "big") % 59,
+    )
+
+
+async def claim_games(games: list[Game]) -> list[Game]:
+    """
+    Work out which of the running games this instance should tick, taking over
+    and handing off game leases as instances come and go.
+    """
+    instances = await leases.heartbeat()
+
+    # somebody else took these over, whatever we have in memory is stale
+    for game_id in await leases.renew_all():
+        await drop_state(game_id)
+        scheduler.forget(game_id)
+
+    # won, or otherwise no longer running
+    active = {game.id for game in games}
+    for game_id in leases.HELD - active:
+        await drop_state(game_id, flush=True)
+        await leases.release(game_id)
+        scheduler.forget(game_id)
+
+    claimed = []
+    acquired = []
     for game in games:
-        asyncio.create_task(game_tick(game, hourly=True))
+        assigned = leases.is_assigned(game.id, instances)
+
+        if game.id in leases.HELD and not assigned:
+            # hand it over to the instance it belongs to now
+            await drop_state(game.id, flush=True)
+            await leases.release(game.id)
+            scheduler.forget(game.id)
+            continue
+
+        if game.id in leases.HELD:
+            claimed.append(game)
+            continue
+
+        if assigned and await leases.acquire(game.id):
+            acquired.append(game.id)
+
+    if acquired:
+        # whoever had these before might have seen them won, so check before
+        # ticking them, and load everything we took over in one go
+        fresh = await loader.find_games(In(Game.id, acquired))
+        for game in fresh:
+            registry.track(game)
+        fresh = [game for game in fresh if not game.winner]
+
+        await load_states(fresh)
+        claimed += fresh
+
+    return claimed
+
+
+@aiocron.crontab("* * * * *", start=False)
+async def games_tick():
+    print("Minutely tick", important=True)
+    await registry.refresh()
+    games = registry.active_games()
+
+    now = time.gmtime()
+    start = minute_start()
+    loop = asyncio.get_running_loop()
+
+    for game in await claim_games(games):
+        second, minute = tick_offsets(game.id)
+        due = start + second
+
+        # every game still gets exactly one tick a minute, just at its own second,
+        # with its hourly work and census on its own minute too
+        loop.call_later(
+            max(0, due - time.time()),
+            functools.partial(
+                scheduler.schedule,
+                game,
+                hourly=now.tm_min == minute,
+                census=(now.tm_min - minute) % 10 == 0,
+                due=due,
+            ),
+        )
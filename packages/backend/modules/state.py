@@ -0,0 +1,468 @@
+import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime, UTC
+import heapq
+from os import getenv
+from typing import Awaitable, Callable
+
+from beanie import Document
+from sanic import exceptions
+from modules.bulk import WriteCollector
+from modules.db import Carrier, Game, Planet, Player, Star, as_utc
+from modules.kernels import PlanetArrays
+from modules.utils import print
+from modules.visibility import Visibility
+from modules import journal, leases, loader, registry
+
+# how many ticks changes are kept in memory before being written back to mongo
+FLUSH_INTERVAL = max(1, int(getenv("STATE_FLUSH_INTERVAL", 1)))
+# how many games get loaded together, sharing one query per collection
+LOAD_BATCH_SIZE = max(1, int(getenv("STATE_LOAD_BATCH_SIZE", 50)))
+
+
+def count_planets(planets: list[Planet]) -> Counter:
+    return Counter(p.occupier for p in planets if p.occupier)
+
+
+class GameState:
+    """
+    Resident copy of a running game. Loaded once, mutated in place by the ticks
+    and the API, and written back to mongo every FLUSH_INTERVAL ticks.
+    """
+
+    def __init__(self, game: Game, stars: list[Star], carriers: list[Carrier]):
+        self.game = game
+        self.stars = stars
+        self.planets = [p for s in stars for p in s.planets]
+        self.planets_by_id = {p.id: p for p in self.planets}
+        # planets owned per player, kept up to date as planets change hands
+        self.planet_counts = count_planets(self.planets)
+        self.carriers = carriers
+        self.carriers_by_id = {c.id: c for c in carriers}
+
+        # (arrival timestamp, carrier id), soonest first. entries go stale when a
+        # carrier is rerouted or destroyed and are skipped when they come up
+        self.arrivals: list[tuple[float, str]] = []
+        # planets that still had enemies on them after their last battle
+        self.contested: set[str] = set()
+
+        self._planet_arrays: PlanetArrays | None = None
+
+        # what each player could see when it was last worked out. dropped for
+        # a player when their planets change, and kept up to date as carriers
+        # land and take off
+        self.visibility: dict[str, Visibility] = {}
+
+        self.dirty: dict[str, Document] = {}
+        self.deleted_carriers: set[str] = set()
+        self.ticks_since_flush = 0
+
+        # held by the tick and by any request mutating the resident documents
+        self.lock = asyncio.Lock()
+
+        now = datetime.now(UTC)
+        # put planets where the last tick left them, which is where the parked
+        # carriers are too. the next tick moves both along together
+        placed_at = as_utc(game.last_tick_at) if game.last_tick_at else now
+        for star in self.stars:
+            for planet in star.planets:
+                if not planet.epoch:
+                    # saved back when theta was rewritten every tick
+                    planet.epoch = placed_at
+                    self.mark_dirty(planet)
+                planet.place(star, game, placed_at)
+
+        for carrier in self.carriers:
+            if carrier.in_flight:
+                self.schedule_arrival(carrier)
+            elif carrier.destination_queue:
+                # saved before carriers flew whole legs at once
+                self.depart(carrier, now)
+
+    @property
+    def members(self) -> list[Player]:
+        return self.game.members
+
+    @property
+    def planet_arrays(self) -> PlanetArrays:
+        if self._planet_arrays is None:
+            self._planet_arrays = PlanetArrays(self.planets, self.stars)
+        return self._planet_arrays
+
+    def get_player(self, player_id: str) -> Player | None:
+        return next((p for p in self.game.members if p.id == player_id), None)
+
+    def get_player_by_user(self, user_id: str) -> Player | None:
+        return next((p for p in self.game.members if p.user == user_id), None)
+
+    def get_planet(self, planet_id: str) -> Planet | None:
+        return self.planets_by_id.get(planet_id)
+
+    def get_carrier(self, carrier_id: str) -> Carrier | None:
+        return self.carriers_by_id.get(carrier_id)
+
+    def victor(self) -> Player | None:
+        """
+        the player holding the game's victory percentage of the planets, if
+        anyone is. only looks at the tallies, so it doesn't touch the planets
+        """
+        if not self.planet_counts:
+            return None
+
+        player_id, count = self.planet_counts.most_common(1)[0]
+        if count * 100 >= len(self.planets) * self.game.settings.victory_percentage:
+            return self.get_player(player_id)
+        return None
+
+    def invalidate_visibility(self, *player_ids: str):
+        for player_id in player_ids:
+            self.visibility.pop(player_id, None)
+
+    def update_carrier_visibility(self, carrier: Carrier):
+        for visibility in self.visibility.values():
+            visibility.update_carrier(carrier)
+
+    def mark_dirty(self, *docs: Document):
+        for doc in docs:
+            self.dirty[doc.id] = doc
+
+    def add_carrier(self, carrier: Carrier):
+        self.carriers.append(carrier)
+        self.carriers_by_id[carrier.id] = carrier
+        self.deleted_carriers.discard(carrier.id)
+        self.update_carrier_visibility(carrier)
+
+    def schedule_arrival(self, carrier: Carrier):
+        heapq.heappush(
+            self.arrivals, (as_utc(carrier.arrives_at).timestamp(), carrier.id)
+        )
+
+    def depart(self, carrier: Carrier, now: datetime):
+        """
+        send a carrier off to its next destination and book its arrival
+        """
+        if carrier.depart(self.game, self.planets_by_id, now):
+            self.schedule_arrival(carrier)
+        self.update_carrier_visibility(carrier)
+        self.mark_dirty(carrier)
+
+    def pop_arrivals(self, until: datetime) -> list[Carrier]:
+        """
+        every carrier due to arrive by until, soonest first
+        """
+        arrived = []
+        until = until.timestamp()
+        while self.arrivals and self.arrivals[0][0] <= until:
+            arrives_at, carrier_id = heapq.heappop(self.arrivals)
+            carrier = self.get_carrier(carrier_id)
+            if (
+                carrier
+                and carrier.in_flight
+                and as_utc(carrier.arrives_at).timestamp() == arrives_at
+            ):
+                arrived.append(carrier)
+        return arrived
+
+    def remove_carriers(self, carriers: list[Carrier]):
+        ids = {c.id for c in carriers}
+        self.carriers = [c for c in self.carriers if c.id not in ids]
+        for carrier_id in ids:
+            self.carriers_by_id.pop(carrier_id, None)
+            self.dirty.pop(carrier_id, None)
+        self.deleted_carriers |= ids
+
+    def game_fields(self) -> dict:
+        # the game itself is shared with the API, so only write what the tick owns
+        fields = {"last_tick_at": self.game.last_tick_at}
+        if self.game.winner:
+            fields["winner"] = self.game.winner
+        return fields
+
+    def journal_record(self) -> dict:
+        """
+        everything not yet flushed, in a form journal.replay can write back
+        """
+        return {
+            "updates": [
+                {"model": type(doc).__name__, "id": doc.id, "set": doc.get_changes()}
+                for doc in self.dirty.values()
+                if doc.is_changed
+            ],
+            "deleted_carriers": list(self.deleted_carriers),
+            "game": self.game_fields(),
+        }
+
+    async def save(self, *docs: Document):
+        """
+        Write documents changed outside of a tick straight to mongo. The journal
+        still has their older values, which a replay would put back, so it gets
+        rewritten with what is pending now.
+        """
+        await asyncio.gather(*(doc.save_changes() for doc in docs))
+        if self.ticks_since_flush and self.game.last_tick_at:
+            await journal.rewrite(self.game.id, self.journal_record())
+
+    async def flush(self):
+        writes = WriteCollector()
+        for doc in self.dirty.values():
+            writes.update(doc)
+        writes.delete(Carrier, list(self.deleted_carriers))
+        if self.game.last_tick_at:
+            writes.set(Game, self.game.id, self.game_fields())
+
+        dirty, deleted = self.dirty, self.deleted_carriers
+        ticks = self.ticks_since_flush
+        self.dirty = {}
+        self.deleted_carriers = set()
+        self.ticks_since_flush = 0
+
+        try:
+            ops = await writes.commit()
+        except Exception:
+            # nothing is known to have made it, so keep all of it for next time
+            self.dirty = {**dirty, **self.dirty}
+            self.deleted_carriers |= deleted
+            self.ticks_since_flush += ticks
+            raise
+        journal.discard(self.game.id)
+        print(f"Flushed {ops} writes for game ({self.game.name}) {self.game.id}")
+
+    async def tick_done(self):
+        self.ticks_since_flush += 1
+        if self.ticks_since_flush >= FLUSH_INTERVAL:
+            await self.flush()
+        elif self.game.last_tick_at:
+            # not in mongo yet, so keep it somewhere that survives a crash
+            await journal.append(self.game.id, self.journal_record())
+
+
+class OwnerTotals:
+    def __init__(self):
+        self.carriers = 0
+        self.ships = 0  # on planets and carriers
+        self.economy = 0
+        self.industry = 0
+        self.science = 0
+
+
+class TickContext:
+    """
+    Lookups for one tick of a game, built once up front and handed to every
+    phase so none of them have to scan the whole galaxy per player or per
+    planet. Combat changes who owns what, so it goes through here to keep
+    the owner maps right.
+    """
+
+    def __init__(self, state: GameState):
+        self.state = state
+        self.players: dict[str, Player] = {p.id: p for p in state.members}
+        self.planets: dict[str, Planet] = state.planets_by_id
+
+        self.planets_by_owner: dict[str, list[Planet]] = {p: [] for p in self.players}
+        for planet in state.planets:
+            if planet.occupier:
+                self.planets_by_owner.setdefault(planet.occupier, []).append(planet)
+
+        self.carriers_by_owner: dict[str, list[Carrier]] = {p: [] for p in self.players}
+        for carrier in state.carriers:
+            self.carriers_by_owner.setdefault(carrier.owner, []).append(carrier)
+
+        self._totals: dict[str, OwnerTotals] | None = None
+
+        # events to save and write news about once the tick's state has settled
+        self.reports: list[Callable[[], Awaitable]] = []
+
+    def owned_planets(self, owner: str) -> list[Planet]:
+        return self.planets_by_owner.get(owner, [])
+
+    def owned_carriers(self, owner: str) -> list[Carrier]:
+        return self.carriers_by_owner.get(owner, [])
+
+    def totals(self, owner: str) -> OwnerTotals:
+        """
+        what an owner has across all their planets and carriers. worked out in
+        one pass for everyone the first time it is asked for after a change
+        """
+        if self._totals is None:
+            self._totals = {}
+            for player_id, planets in self.planets_by_owner.items():
+                t = self._totals[player_id] = OwnerTotals()
+                for planet in planets:
+                    t.ships += planet.ships
+                    t.economy += planet.economy
+                    t.industry += planet.industry
+                    t.science += planet.science
+            for player_id, carriers in self.carriers_by_owner.items():
+                t = self._totals.setdefault(player_id, OwnerTotals())
+                t.carriers = len(carriers)
+                t.ships += sum(c.ships for c in carriers)
+
+        return self._totals.get(owner) or OwnerTotals()
+
+    def invalidate(self):
+        self._totals = None
+
+    def set_occupier(self, planet: Planet, owner: str | None):
+        counts = self.state.planet_counts
+        # only the coverage of whoever lost or gained the planet changes
+        self.state.invalidate_visibility(*filter(None, (planet.occupier, owner)))
+        if planet.occupier:
+            self.planets_by_owner[planet.occupier] = [
+                p for p in self.owned_planets(planet.occupier) if p.id != planet.id
+            ]
+            counts[planet.occupier] -= 1
+            if counts[planet.occupier] <= 0:
+                del counts[planet.occupier]
+        if owner:
+            self.planets_by_owner.setdefault(owner, []).append(planet)
+            counts[owner] += 1
+        planet.occupier = owner
+        self.invalidate()
+
+    def remove_carriers(self, carriers: list[Carrier]):
+        ids = {c.id for c in carriers}
+        for owner in {c.owner for c in carriers}:
+            self.carriers_by_owner[owner] = [
+                c for c in self.owned_carriers(owner) if c.id not in ids
+            ]
+        self.state.remove_carriers(carriers)
+        self.invalidate()
+
+
+GAME_STATES: dict[str, GameState] = {}
+_LOADING: dict[str, asyncio.Task] = {}
+# games having their galaxy wiped and regenerated, which mustn't be loaded meanwhile
+_RESETTING: set[str] = set()
+
+
+async def _load_states(games: list[Game]) -> dict[str, GameState]:
+    stars_by_game, carriers_by_game = await loader.load_galaxies(
+        [game.id for game in games]
+    )
+
+    states = {}
+    for game in games:
+        carriers = carriers_by_game.get(game.id, [])
+        state = GameState(game, stars_by_game.get(game.id, []), carriers)
+        GAME_STATES[game.id] = states[game.id] = state
+
+        print(
+            f"Loaded state for game ({game.name}) {game.id}: {len(state.planets)} planets, {len(carriers)} carriers"
+        )
+    return states
+
+
+def _start_loading(games: list[Game]) -> asyncio.Task:
+    task = asyncio.create_task(_load_states(games))
+    ids = [game.id for game in games]
+    for game_id in ids:
+        _LOADING[game_id] = task
+
+    def done(_):
+        for game_id in ids:
+            _LOADING.pop(game_id, None)
+
+    task.add_done_callback(done)
+    return task
+
+
+async def load_state(game: Game) -> GameState:
+    # share a single load between everything asking for the same game at once
+    if not (task := _LOADING.get(game.id)):
+        task = _start_loading([game])
+
+    return (await asyncio.shield(task))[game.id]
+
+
+async def load_states(games: list[Game]):
+    """
+    Load many games at once, LOAD_BATCH_SIZE at a time with one query per
+    collection per batch, instead of a few queries per game.
+    """
+    games = [
+        g
+        for g in games
+        if g.id not in GAME_STATES and g.id not in _LOADING and g.id not in _RESETTING
+    ]
+    for i in range(0, len(games), LOAD_BATCH_SIZE):
+        await asyncio.shield(_start_loading(games[i : i + LOAD_BATCH_SIZE]))
+
+
+def get_loaded_state(game_id: str) -> GameState | None:
+    return GAME_STATES.get(game_id)
+
+
+async def get_state(game: Game) -> GameState:
+    """
+    Get the resident state for a started game, loading it if needed. Only the
+    instance holding the game's lease keeps it resident, anyone else gets
+    NotLeader.
+    """
+    if state := GAME_STATES.get(game.id):
+        return state
+
+    if game.id in _RESETTING:
+        raise exceptions.ServiceUnavailable("Game is restarting, try again")
+
+    if not await leases.acquire(game.id):
+        raise leases.NotLeader(game.id, await leases.get_lease(game.id))
+
+    return await load_state(game)
+
+
+async def drop_state(game_id: str, flush: bool = False):
+    if not (state := GAME_STATES.get(game_id)):
+        return
+
+    async with state.lock:
+        if flush:
+            await state.flush()
+        else:
+            journal.discard(game_id)
+        GAME_STATES.pop(game_id, None)
+
+
+def abandon_state(game_id: str):
+    """
+    forget a game's resident state without writing it back or touching its
+    journal, for when a tick was cut off halfway through it
+    """
+    GAME_STATES.pop(game_id, None)
+
+
+@asynccontextmanager
+async def resetting(game_id: str):
+    """
+    Throw away a game's resident state without writing it back and keep it from
+    being loaded again until the block is done, so its galaxy can be rebuilt
+    without a tick or request picking up a half wiped copy.
+    """
+    _RESETTING.add(game_id)
+    try:
+        if task := _LOADING.get(game_id):
+            # let a load that started before us land, so it can be dropped
+            await asyncio.gather(asyncio.shield(task), return_exceptions=True)
+        await drop_state(game_id)
+        yield
+    finally:
+        _RESETTING.discard(game_id)
+
+
+async def load_all_states():
+    games = registry.active_games()
+    instances = await leases.heartbeat()
+
+    # only pick up the games this instance is meant to be ticking
+    games = [
+        game
+        for game in games
+        if leases.is_assigned(game.id, instances) and await leases.acquire(game.id)
+    ]
+    await load_states(games)
+
+
+async def flush_all_states():
+    for state in list(GAME_STATES.values()):
+        async with state.lock:
+            await state.flush()
@@ -0,0 +1,107 @@
+from datetime import datetime
+from os import getenv
+
+from modules.db import Carrier, Game, Planet, Player, SpatialGrid
+
+# how far (in light years) planets may have orbited since a player's visibility
+# was worked out before it is worked out again. every planet orbits at the same
+# speed, so this is really a time limit
+VISIBILITY_SLACK = float(getenv("VISIBILITY_SLACK", 0.1))
+
+
+class Coverage:
+    """
+    The part of the galaxy a player can see: everything within their scan
+    distance of one of their planets. The planets are bucketed in cells the
+    size of the scan distance, so checking a point only looks at the planets
+    in the 3x3 cells around it instead of all of them.
+    """
+
+    def __init__(self, planets: list[Planet], scan_distance: float):
+        self.scan_distance = scan_distance
+        self.grid = SpatialGrid(planets, cell_size=scan_distance or 1)
+
+    def covers(self, point) -> bool:
+        return self.grid.any_within(point, self.scan_distance)
+
+    def visible(self, points) -> list[bool]:
+        any_within, r = self.grid.any_within, self.scan_distance
+        return [any_within(point, r) for point in points]
+
+
+class Visibility:
+    """
+    What a player can see besides their own things, kept on the game state
+    between scans. Planets and parked carriers are worked out once, and the
+    entries of carriers are updated as they land and take off. Carriers in
+    flight are checked where they are at the time, against the same coverage.
+    """
+
+    def __init__(
+        self,
+        coverage: Coverage,
+        placed_at: datetime,
+        planets: set[str],
+        carriers: set[str],
+    ):
+        self.coverage = coverage
+        self.scan_distance = coverage.scan_distance
+        self.placed_at = placed_at  # when the planets were where this saw them
+        self.planets = planets
+        self.carriers = carriers  # parked ones only
+
+    def sees_carrier(self, carrier: Carrier, position) -> bool:
+        if carrier.in_flight:
+            return self.coverage.covers(position)
+        return carrier.id in self.carriers
+
+    def update_carrier(self, carrier: Carrier):
+        if not carrier.in_flight and self.coverage.covers(carrier.position):
+            self.carriers.add(carrier.id)
+        else:
+            self.carriers.discard(carrier.id)
+
+    def is_stale(self, player: Player, game: Game, placed_at: datetime) -> bool:
+        if self.scan_distance != player.get_scan_distance():
+            return True
+        minutes = (placed_at - self.placed_at).total_seconds() / 60
+        return abs(minutes) * game.settings.orbit_speed > VISIBILITY_SLACK
+
+
+def see(
+    player: Player,
+    placed_at: datetime,
+    planets: list[Planet],
+    carriers: list[Carrier],
+) -> Visibility:
+    coverage = Coverage(
+        [p for p in planets if p.occupier == player.id], player.get_scan_distance()
+    )
+
+    parked = [c for c in carriers if not c.in_flight]
+    planets_seen = coverage.visible(p.position for p in planets)
+    carriers_seen = coverage.visible(c.position for c in parked)
+    return Visibility(
+        coverage,
+        placed_at,
+        {p.id for p, seen in zip(planets, planets_seen) if seen},
+        {c.id for c, seen in zip(parked, carriers_seen) if seen},
+    )
+
+
+def get_visibility(
+    cache: dict[str, Visibility],
+    player: Player,
+    game: Game,
+    placed_at: datetime,
+    planets: list[Planet],
+    carriers: list[Carrier],
+) -> Visibility:
+    """
+    the player's cached visibility, worked out again if their scan distance
+    changed or the planets have orbited too far since
+    """
+    seen = cache.get(player.id)
+    if seen is None or seen.is_stale(player, game, placed_at):
+        seen = cache[player.id] = see(player, placed_at, planets, carriers)
+    return seen
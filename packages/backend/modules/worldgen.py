@@ -2,7 +2,7 @@ import math
 import random
 import asyncio
 
-from modules.db import Position, distance
+from modules.db import Position, Vec, distance
 from modules.utils import (
     GREEK_LETTERS,
     CONSTELLATIONS,
@@ -44,16 +44,17 @@ def generate_carrier_name(seed: int) -> str:
 def system_gen_worker(
     player_count: int, stars_per_player: int, starting_system_size: int
 ) -> tuple[list[tuple[Position, int]], list[Position]]:
-    player_stars: list[Position] = []
-    star_positions: list[Position] = []
+    player_stars: list[Vec] = []
+    star_positions: list[Vec] = []
 
     galaxy_size = GALAXY_SIZE_PER_STAR * player_count * stars_per_player
+    origin = Vec(0, 0)
 
     # make some stars for the players exactly on the edge of the galaxy so they're evenly spaced
     for i in range(player_count):
         theta = i * (2 * 3.14159) / player_count
         x, y = galaxy_size / 2 * math.cos(theta), galaxy_size / 2 * math.sin(theta)
-        player_stars.append(Position(x=x, y=y))
+        player_stars.append(Vec(x, y))
 
     # generate points on a grid, only only within the galaxy, then shuffle them
     for x in range(
@@ -62,16 +63,12 @@ def system_gen_worker(
         MIN_STAR_DISTANCE,
     ):
         for y in range(-int(galaxy_size / 2), int(galaxy_size / 2), MIN_STAR_DISTANCE):
-            pos = Position(
-                x=x
-                + random.random() * (MIN_STAR_DISTANCE / 1.8)
-                - MIN_STAR_DISTANCE / 2,
-                y=y
-                + random.random() * (MIN_STAR_DISTANCE / 1.8)
-                - MIN_STAR_DISTANCE / 2,
+            pos = Vec(
+                x + random.random() * (MIN_STAR_DISTANCE / 1.8) - MIN_STAR_DISTANCE / 2,
+                y + random.random() * (MIN_STAR_DISTANCE / 1.8) - MIN_STAR_DISTANCE / 2,
             )
             if (
-                distance(pos, Position(x=0, y=0)) < galaxy_size / 2
+                distance(pos, origin) < galaxy_size / 2
                 and any(
                     distance(pos, star) < starting_system_size + 2
                     for star in player_stars
@@ -106,7 +103,10 @@ def system_gen_worker(
 
         star_sizes[i] = star_dist
 
-    return zip(star_positions, star_sizes), player_stars
+    return (
+        [(pos.to_position(), size) for pos, size in zip(star_positions, star_sizes)],
+        [pos.to_position() for pos in player_stars],
+    )
 
 
 async def generate_star_positions(
@@ -1,6 +1,6 @@
 import { Channel, channelStore } from "./channels";
 import { Message, messageStore } from "./messages";
-import { Scan, scanStore } from "./scan";
+import { Scan, ScanDelta, applyScanDelta, scanStore } from "./scan";
 import { tokenStore, useToken } from "./token";
 import { User, userStore } from "./users";
 import useWebSocket, { ReadyState } from "react-use-websocket";
@@ -21,6 +21,8 @@ export enum GatewayOpcode {
   USER_UPDATE = 12,
   REQUEST_CHANNELS = 13,
   GALAXY_SCAN = 14,
+  GALAXY_SCAN_DELTA = 15,
+  GALAXY_SCAN_ACK = 16,
 }
 
 const connectionStatus = {
@@ -91,8 +93,38 @@ export type GatewayMessage =
   | {
       op: GatewayOpcode.GALAXY_SCAN;
       d: Scan;
+    }
+  | {
+      op: GatewayOpcode.GALAXY_SCAN_DELTA;
+      d: ScanDelta;
     };
 
+// the last few scans received for the current game, exactly as the server sent
+// them, so deltas can be applied to whichever one they were made against
+const SCAN_HISTORY = 4;
+let scanHistory: { game: ID | null; scans: Map<number, Scan> } = {
+  game: null,
+  scans: new Map(),
+};
+
+function rememberScan(scan: Scan) {
+  if (scan.seq === undefined) return;
+  if (scanHistory.game !== scan.game) {
+    scanHistory = { game: scan.game, scans: new Map() };
+  }
+
+  scanHistory.scans.set(scan.seq, scan);
+  for (const seq of Array.from(scanHistory.scans.keys())) {
+    if (seq <= scan.seq - SCAN_HISTORY) {
+      scanHistory.scans.delete(seq);
+    }
+  }
+}
+
+function getRememberedScan(game: ID, seq: number) {
+  return scanHistory.game === game ? scanHistory.scans.get(seq) : undefined;
+}
+
 function prettyPrint(...args: any[]) {
   return console.log("[GATEWAY]", ...args);
 }
@@ -173,9 +205,44 @@ export function useGateway() {
             prettyPrint("GALAXY SCAN:", data.d);
             scanStore.getState().setScan(data.d);
             scanStore.getState().setLastTick(Date.now());
+
+            if (data.d.seq !== undefined) {
+              rememberScan(data.d);
+              sendJsonMessage({
+                op: GatewayOpcode.GALAXY_SCAN_ACK,
+                d: { game: data.d.game, seq: data.d.seq },
+              });
+            }
           }
           break;
         }
+        case GatewayOpcode.GALAXY_SCAN_DELTA: {
+          const currentScan = scanStore.getState().scan;
+          if (currentScan?.game !== data.d.game) {
+            break;
+          }
+
+          const base = getRememberedScan(data.d.game, data.d.base);
+          if (!base) {
+            // we don't have what this was made against, ask for a full scan
+            sendJsonMessage({
+              op: GatewayOpcode.GALAXY_SCAN_ACK,
+              d: { game: data.d.game, seq: null },
+            });
+            break;
+          }
+
+          const scan = applyScanDelta(base, data.d);
+          prettyPrint("GALAXY SCAN DELTA:", data.d);
+          rememberScan(scan);
+          scanStore.getState().setScan(scan);
+          scanStore.getState().setLastTick(Date.now());
+          sendJsonMessage({
+            op: GatewayOpcode.GALAXY_SCAN_ACK,
+            d: { game: scan.game, seq: scan.seq },
+          });
+          break;
+        }
         default: {
           prettyPrint("Unhandled opcode:", data.op);
         }
@@ -77,12 +77,70 @@ export type Player = {
 
 export type Scan = {
   game: ID;
+  seq?: number; // only on scans sent over the gateway
   stars: Star[];
   planets: Planet[];
   carriers: Carrier[];
   players: Player[];
 };
 
+type EntityDelta<T> = {
+  changed: (Partial<T> & { id: ID })[]; // new entities in full, changed fields otherwise
+  dropped: Record<ID, string[]>; // fields an entity no longer has
+  removed: ID[];
+};
+
+export type ScanDelta = {
+  game: ID;
+  seq: number;
+  base: number; // seq of the scan this applies to
+  stars: EntityDelta<Star>;
+  planets: EntityDelta<Planet>;
+  carriers: EntityDelta<Carrier>;
+  players: EntityDelta<Player>;
+};
+
+function applyEntityDelta<T extends { id: ID }>(
+  entities: T[],
+  delta: EntityDelta<T>
+): T[] {
+  const removed = new Set(delta.removed);
+  const byId = new Map<ID, T>();
+  for (const entity of entities) {
+    if (!removed.has(entity.id)) {
+      byId.set(entity.id, entity);
+    }
+  }
+
+  for (const change of delta.changed) {
+    byId.set(change.id, { ...byId.get(change.id), ...change } as T);
+  }
+
+  for (const [id, keys] of Object.entries(delta.dropped)) {
+    const entity = byId.get(id);
+    if (!entity) continue;
+
+    const next: Record<string, unknown> = { ...entity };
+    for (const key of keys) {
+      delete next[key];
+    }
+    byId.set(id, next as T);
+  }
+
+  return Array.from(byId.values());
+}
+
+export function applyScanDelta(base: Scan, delta: ScanDelta): Scan {
+  return {
+    game: delta.game,
+    seq: delta.seq,
+    stars: applyEntityDelta(base.stars, delta.stars),
+    planets: applyEntityDelta(base.planets, delta.planets),
+    carriers: applyEntityDelta(base.carriers, delta.carriers),
+    players: applyEntityDelta(base.players, delta.players),
+  };
+}
+
 export const scanStore = create<{
   scan: Scan | null;
   setScan: (scan: Scan | null) => void;